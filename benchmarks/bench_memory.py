@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark of the EPG held between retrieving and rendering it: the
+event dicts returned by .json() against the compact events parsed from the
+streamed responses (getEPGs), on a guide served by the fake OpenWebif server.
+
+Each way of retrieving the EPG runs in its own process so their peak RSS can
+be compared.
+
+Usage: python benchmarks/bench_memory.py [--services 200] [--events 336]
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import owi2plex
+from tests.fake_openwebif import FakeOpenWebif
+
+
+def retrieveDicts(bouquets_services, api_root_url, session):
+    epg = {}
+    for services in bouquets_services.values():
+        for service in services:
+            url = '{}/api/epgservice?sRef={}'.format(api_root_url,
+                service['servicereference'])
+            epg[service['program']] = session.get(url).json()['events']
+    return epg
+
+
+def measure(mode, api_root_url):
+    session = owi2plex.setSession(owi2plex.createSession())
+    bouquets = owi2plex.getBouquets(None, api_root_url, False)
+    bouquets_services = owi2plex.getBouquetsServices(bouquets, api_root_url)
+    tracemalloc.start()
+    if mode == 'dicts':
+        epg = retrieveDicts(bouquets_services, api_root_url, session)
+    else:
+        epg = owi2plex.getEPGs(bouquets_services, api_root_url)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # ru_maxrss is in kilobytes on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print('{} {} {} {}'.format(sum(len(e) for e in epg.values()), retained, peak, rss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--bouquets', default=1, type=int)
+    parser.add_argument('--services', default=200, type=int)
+    parser.add_argument('--events', default=336, type=int,
+        help='Events per service. 336 is 7 days of half hour programmes.')
+    parser.add_argument('--measure', choices=['dicts', 'compact'], help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.url)
+        return 0
+
+    fake = FakeOpenWebif(args.bouquets, args.services, args.events)
+    api_root_url = fake.serve()
+    results = {}
+    try:
+        for mode in ('dicts', 'compact'):
+            output = subprocess.check_output([sys.executable, __file__,
+                '--measure', mode, '--url', api_root_url])
+            results[mode] = [int(n) for n in output.split()]
+    finally:
+        fake.stop()
+
+    mb = 1024.0 * 1024.0
+    for mode, (events, retained, peak, rss) in results.items():
+        print('{:>8}: {} events, {:.1f} MB retained, {:.1f} MB peak allocated, '
+            '{:.1f} MB peak RSS'.format(mode, events, retained / mb, peak / mb, rss / mb))
+    print('Retained {:.1f}x less, peak RSS {:.1f}x lower'.format(
+        results['dicts'][1] / max(results['compact'][1], 1),
+        results['dicts'][3] / max(results['compact'][3], 1)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
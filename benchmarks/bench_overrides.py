@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the category overrides matching: the Aho-Corasick automaton of
+CategoryOverrides against checking every pattern against every title.
+
+Usage: python benchmarks/bench_overrides.py [number_of_patterns ...]
+"""
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from owi2plex import CategoryOverrides
+
+
+CATEGORIES = ['News', 'Sports', 'Football', 'Series', 'Movie', 'Kids']
+
+
+def random_words(rnd, n):
+    return ' '.join(
+        ''.join(rnd.choice(string.ascii_letters) for _ in range(rnd.randint(3, 9)))
+        for _ in range(n))
+
+
+def naive_match(overrides, title):
+    categories = []
+    for pattern, override_categories in overrides.items():
+        if pattern in title.upper():
+            categories.extend(override_categories)
+    return categories
+
+
+def bench(number_of_patterns, number_of_titles=20000):
+    rnd = random.Random(number_of_patterns)
+    overrides = {}
+    for _ in range(number_of_patterns):
+        overrides[random_words(rnd, rnd.randint(1, 3)).upper()] = [rnd.choice(CATEGORIES)]
+    patterns = list(overrides)
+    titles = []
+    for _ in range(number_of_titles):
+        title = random_words(rnd, rnd.randint(2, 6))
+        if rnd.random() < 0.2:
+            title = '{}: {}'.format(rnd.choice(patterns).title(), title)
+        titles.append(title)
+
+    automaton = CategoryOverrides(overrides)
+    naive = timeit.timeit(lambda: [naive_match(overrides, t) for t in titles], number=1)
+    compiled = timeit.timeit(lambda: [automaton.match(t) for t in titles], number=1)
+    assert [naive_match(overrides, t) for t in titles] == [automaton.match(t) for t in titles]
+    print('{:>6} patterns, {} titles: naive {:.3f}s, aho-corasick {:.3f}s ({:.1f}x)'.format(
+        number_of_patterns, number_of_titles, naive, compiled, naive / compiled))
+
+
+if __name__ == '__main__':
+    for number_of_patterns in [int(n) for n in sys.argv[1:]] or [10, 100, 500, 2000]:
+        bench(number_of_patterns)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the formatting of the programme start/stop times: the
+memoised formatXMLTVTime against the previous datetime/strftime path with a
+single offset from UTC.
+
+Usage: python benchmarks/bench_timestamps.py [number_of_events ...]
+"""
+import os
+import random
+import sys
+import timeit
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from owi2plex import formatXMLTVTime
+
+
+def strftime_path(events, tzoffset='+0100'):
+    for begin_timestamp, duration in events:
+        start_dt = datetime.fromtimestamp(begin_timestamp)
+        start_dt.strftime("%Y%m%d%H%M%S {}".format(tzoffset))
+        end_dt = start_dt + timedelta(minutes=duration)
+        end_dt.strftime("%Y%m%d%H%M%S {}".format(tzoffset))
+
+
+def formatter_path(events):
+    for begin_timestamp, duration in events:
+        formatXMLTVTime(begin_timestamp)
+        formatXMLTVTime(begin_timestamp + duration * 60)
+
+
+def bench(number_of_events):
+    rnd = random.Random(number_of_events)
+    now = int(datetime.now().timestamp()) // 1800 * 1800
+    # 7 days of programmes starting every 5 minutes, like a real guide
+    events = [(now + rnd.randrange(0, 7 * 86400, 300), rnd.choice([5, 30, 60, 90, 120]))
+        for _ in range(number_of_events)]
+    formatXMLTVTime.cache_clear()
+    old = timeit.timeit(lambda: strftime_path(events), number=1)
+    cold = timeit.timeit(lambda: formatter_path(events), number=1)
+    warm = timeit.timeit(lambda: formatter_path(events), number=1)
+    print('{:>8} events: strftime {:.3f}s, formatXMLTVTime {:.3f}s cold ({:.1f}x) '
+        '{:.3f}s warm ({:.1f}x)'.format(
+            number_of_events, old, cold, old / cold, warm, old / warm))
+
+
+if __name__ == '__main__':
+    for number_of_events in [int(n) for n in sys.argv[1:]] or [10000, 100000, 500000]:
+        bench(number_of_events)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+End to end benchmark of owi2plex against the fake OpenWebif server of the
+tests, at several scales of bouquets x services x events.
+
+It times the phases of main:
+    - fetch: bouquets, services and EPGs from the server (retrieveEPG)
+    - parse: event texts of every event with a cold cache (parseEventText)
+    - render: XMLTV payload in memory (generateXMLTV)
+    - write: XMLTV to a file (writeXMLTV)
+
+The results are saved as JSON in benchmarks/results so they can be compared
+between versions with --compare.
+
+Usage: python benchmarks/run_benchmarks.py [--scales 2x25x50,4x100x100]
+           [--latency 0.005] [--workers 4] [--days 1] [--compare previous.json]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import timeit
+
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import owi2plex
+from tests.fake_openwebif import FakeOpenWebif
+
+
+PHASES = ['fetch', 'parse', 'render', 'write']
+
+
+def timed(function):
+    start = timeit.default_timer()
+    result = function()
+    return result, timeit.default_timer() - start
+
+
+def bench(bouquets, services, events, latency, workers, fetch_mode, days=None):
+    fake = FakeOpenWebif(bouquets, services, events, latency=latency)
+    api_root_url = fake.serve()
+    owi2plex.setSession(owi2plex.createSession(pool_size=workers))
+    owi2plex.parseEventText.cache_clear()
+    owi2plex.formatXMLTVTime.cache_clear()
+    timings = {}
+    try:
+        (bouquets_services, epg, failures), timings['fetch'] = timed(
+            lambda: owi2plex.retrieveEPG(None, api_root_url, max_workers=workers,
+                fetch_mode=fetch_mode, window=owi2plex.makeEPGWindow(days=days)))
+
+        def parse():
+            for service_events in epg.values():
+                for event in service_events:
+                    owi2plex.parseEventText(event['title'], event['shortdesc'], event['longdesc'])
+        _, timings['parse'] = timed(parse)
+        owi2plex.parseEventText.cache_clear()
+
+        xmltv, timings['render'] = timed(lambda: owi2plex.generateXMLTV(
+            bouquets_services, epg, api_root_url, False, None))
+        owi2plex.parseEventText.cache_clear()
+        owi2plex.formatXMLTVTime.cache_clear()
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_file = os.path.join(output_dir, 'epg.xml')
+            _, timings['write'] = timed(lambda: owi2plex.writeXMLTV(
+                output_file, bouquets_services, epg, api_root_url, False, None))
+            output_bytes = os.path.getsize(output_file)
+    finally:
+        fake.stop()
+
+    return {
+        'scale': {'bouquets': bouquets, 'services': services, 'events': events},
+        'requests': fake.requests,
+        'failures': len(failures),
+        'channels': sum(len(s) for s in bouquets_services.values()),
+        'programmes': sum(len(e) for e in epg.values()),
+        'output_bytes': output_bytes,
+        'timings': timings,
+    }
+
+
+def scaleName(result):
+    return '{bouquets}x{services}x{events}'.format(**result['scale'])
+
+
+def compare(results, previous_file, threshold):
+    """
+    Prints the change of every phase against a previous results file and
+    returns the number of phases that are slower by more than threshold.
+    """
+    with open(previous_file) as f:
+        previous = dict((scaleName(r), r) for r in json.load(f)['results'])
+    regressions = 0
+    for result in results:
+        before = previous.get(scaleName(result))
+        if not before:
+            continue
+        for phase in PHASES:
+            ratio = result['timings'][phase] / max(before['timings'][phase], 1e-9)
+            flag = ''
+            if ratio > 1 + threshold:
+                regressions += 1
+                flag = '  <-- REGRESSION'
+            print('{:>12} {:>7}: {:.3f}s -> {:.3f}s ({:+.0%}){}'.format(
+                scaleName(result), phase, before['timings'][phase],
+                result['timings'][phase], ratio - 1, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scales', default='2x25x50,4x100x100,8x100x300',
+        help='Comma separated list of bouquets x services x events.')
+    parser.add_argument('--latency', default=0.0, type=float,
+        help='Seconds added by the fake server to every request.')
+    parser.add_argument('--workers', default=4, type=int)
+    parser.add_argument('--fetch-mode', default='service', choices=['service', 'bouquet'])
+    parser.add_argument('--days', type=float,
+        help='Only fetch and render the programmes of this many days.')
+    parser.add_argument('--output', help='Results file. Defaults to '
+        'benchmarks/results/benchmark-<version>-<date>.json')
+    parser.add_argument('--compare', help='Previous results file to compare with.')
+    parser.add_argument('--threshold', default=0.2, type=float,
+        help='Slowdown of a phase reported as a regression.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = []
+    for scale in args.scales.split(','):
+        bouquets, services, events = (int(n) for n in scale.split('x'))
+        result = bench(bouquets, services, events, args.latency, args.workers,
+            args.fetch_mode, args.days)
+        results.append(result)
+        print('{:>12}: {} channels, {} programmes, {} requests, {} bytes | {}'.format(
+            scaleName(result), result['channels'], result['programmes'],
+            result['requests'], result['output_bytes'], ', '.join(
+                '{} {:.3f}s'.format(p, result['timings'][p]) for p in PHASES)))
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+        'benchmark-{}-{}.json'.format(owi2plex.__version__,
+            datetime.now().strftime('%Y%m%d%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'version': owi2plex.__version__,
+            'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': vars(args),
+            'results': results,
+        }, f, indent=2)
+    print('Results saved to {}'.format(output))
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,10 @@
 import sys
 import os
 import pytest
+import collections
+import json
+
+from requests.models import Response
 
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -27,3 +31,68 @@ def bouquet_api_call():
     }
     return response
 
+
+
+@pytest.fixture(scope='session')
+def bouquets_services():
+    services = collections.OrderedDict()
+    services['TV'] = [
+        {"servicereference": "1:0:19:1B1D:802:2:11A0000:0:0:0:", "servicename": "RTÉ One HD", "program": 6941, "pos": 1},
+        {"servicereference": "1:0:19:1B1E:802:2:11A0000:0:0:0:", "servicename": "RTÉ2 HD", "program": 6942, "pos": 2},
+        {"servicereference": "1:64:0:0:0:0:0:0:0:0:", "servicename": "- Separator -", "program": 0, "pos": 0},
+        {"servicereference": "1:0:19:1B1F:802:2:11A0000:0:0:0:", "servicename": "Virgin Media One", "program": 6943, "pos": 3},
+    ]
+    return services
+
+
+@pytest.fixture(scope='session')
+def epgservice_api_call():
+    def events(sref):
+        return {
+            "events": [
+                {"id": 100, "sref": sref, "begin_timestamp": 1571324400, "duration": 30,
+                 "title": "News: Six One", "shortdesc": "[News] The latest news.",
+                 "longdesc": "", "picon": "/picon/1_0_19_1B1D_802_2_11A0000_0_0_0.png"},
+                {"id": 101, "sref": sref, "begin_timestamp": 1571326200, "duration": 60,
+                 "title": "New: Doctor Who", "shortdesc": "[Drama] The Timeless Child. (S12 Ep10/10)",
+                 "longdesc": "The Doctor faces the Master.", "picon": "/picon/1_0_19_1B1D_802_2_11A0000_0_0_0.png"},
+            ],
+            "result": True
+        }
+    return events
+
+
+@pytest.fixture
+def epg(bouquets_services, epgservice_api_call):
+    result = collections.OrderedDict()
+    for service in bouquets_services['TV']:
+        if service['pos']:
+            result[service['program']] = epgservice_api_call(service['servicereference'])['events']
+    return result
+
+
+@pytest.fixture
+def fake_openwebif():
+    from tests.fake_openwebif import FakeOpenWebif
+    servers = []
+
+    def start(**kwargs):
+        fake = FakeOpenWebif(**kwargs)
+        fake.serve()
+        servers.append(fake)
+        return fake
+
+    yield start
+    for fake in servers:
+        fake.stop()
+
+
+@pytest.fixture(scope='session')
+def json_response():
+    def response(data):
+        result = Response()
+        result.status_code = 200
+        result._content = json.dumps(data).encode('utf-8')
+        result._content_consumed = True
+        return result
+    return response
@@ -1,21 +1,50 @@
 #!/usr/bin/env python3
 import click
-import requests
 import re
 import collections
-import yaml
 import os
 import html
 import codecs
 import logging
-
-from lxml import etree
-from datetime import datetime, timedelta, time
-
-
-__version__ = ''
-exec(open(os.path.dirname(os.path.realpath(__file__))+'/version.py').read())
-logger = None
+import json
+import threading
+import functools
+import sys
+import hashlib
+import operator
+import tempfile
+import time
+import contextlib
+import timeit
+import io
+import bisect
+import itertools
+import statistics
+import cProfile
+import gzip
+import lzma
+import pstats
+import tracemalloc
+
+import concurrent.futures
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from time import localtime, sleep
+from urllib.parse import quote, unquote, urlsplit
+
+
+logger = logging.getLogger('OWI2PLEX')
+http_session = None
+render_overrides = None
+
+CONTROL_CHARS_RE = re.compile(u'[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+')
+CATEGORIES_RE = re.compile(r'^\[(?P<C1>[\w\s]+)[\.\s]*(?P<C2>[\w\s]+)*\]')
+SUBTITLE_CATEGORIES_RE = re.compile(r'^(\[.+\]\s*)')
+SUBTITLE_SERIES_RE = re.compile(r'\s*\([SE]\d+.*\)')
+C4_STYLE_SEP_RE = re.compile(r'(?:S(?P<S>\d+)(?:\/|\s)*)?(?:Ep|E)\s*(?P<E>\d+)(?:\/(?P<P>\d+))?')
+BBC_STYLE_SEP_RE = re.compile(r'^(?P<E>\d+)\/(?P<P>\d+)\.')
+ORIGINAL_AIR_DATE_RE = re.compile(r'(\d{2})[\/|\.|\-](\d{2})[\/|\.|\-](\d{4})')
 
 
 def unescape(text):
@@ -28,7 +57,7 @@ def unescape(text):
     This function also replaces control characters for XML compatibility
     """
     try:
-        text = re.sub(u'[^\u0020-\uD7FF\u0009\u000A\u000D\uE000-\uFFFD\U00010000-\U0010FFFF]+', '', text)
+        text = CONTROL_CHARS_RE.sub('', text)
         return html.unescape(text)
     except:
         return text
@@ -40,18 +69,806 @@ def getAPIRoot(username, password, host, port):
     More info at:
     
     https://github.com/E2OpenPlugins/e2openplugin-OpenWebif/wiki/OpenWebif-API-documentation
+
+    The credentials are URL encoded, so they can have any character.
     """
     if username:
-        url = 'http://{}:{}@{}:{}'.format(
-                username, password, host, port)
+        url = 'http://{}:{}@{}:{}'.format(quote(username, safe=''),
+                quote(password or '', safe=''), host, port)
     else:
         url = 'http://{}:{}'.format(host, port)
     return url
 
 
-def getBouquets(bouquet, api_root_url, list_bouquets):
+Receiver = collections.namedtuple('Receiver', ['name', 'api_root_url', 'bouquet'])
+
+
+def parseReceiver(spec, default_port=80):
+    """
+    Function to get a receiver from the value of a --receiver option,
+    formatted as [username:password@]host[:port][/bouquet]. The credentials
+    and the bouquet name can be URL encoded, e.g. 192.168.0.151/Sky%20UK.
+
+    returns:
+        - type: Receiver
+        - model: Receiver("host:port", api_root_url, bouquet_name_or_None)
+    """
+    parts = urlsplit('//' + spec)
+    if not parts.hostname:
+        raise ValueError(u"Invalid receiver {}".format(spec))
+    port = parts.port or default_port
+    username = unquote(parts.username) if parts.username else None
+    password = unquote(parts.password) if parts.password else None
+    return Receiver('{}:{}'.format(parts.hostname, port),
+        getAPIRoot(username, password, parts.hostname, port),
+        unquote(parts.path.lstrip('/')) or None)
+
+
+def createSession(timeout=30, retries=3, backoff_factor=0.5, pool_size=10):
+    """
+    Function to create the HTTP session shared by all the requests to the
+    OpenWebif API. Connections are pooled and kept alive, every request gets
+    a default timeout and connection errors and 5xx responses are retried
+    with exponential backoff.
+    """
+    # requests is slow to import, the commands that don't fetch skip it
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    class OpenWebifSession(requests.Session):
+        def request(self, method, url, **kwargs):
+            kwargs.setdefault('timeout', self.timeout)
+            return super().request(method, url, **kwargs)
+
+    session = OpenWebifSession()
+    session.timeout = timeout
+    retry = Retry(
+        total=retries, connect=retries, read=retries, status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+@functools.lru_cache(maxsize=None)
+def getVersion():
+    """
+    Function to read the version of the package from version.py.
+    """
+    namespace = {}
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'version.py')) as f:
+        exec(f.read(), namespace)
+    return namespace['__version__']
+
+
+__version__ = getVersion()
+
+
+def getSession():
+    """
+    Function to get the shared HTTP session, creating one with the default
+    settings if none has been set with setSession.
+    """
+    global http_session
+    if http_session is None:
+        http_session = createSession()
+    return http_session
+
+
+def setSession(session):
+    """
+    Function to replace the shared HTTP session. Any object with a
+    requests-like get method can be used, e.g. a stand-in for tests.
+    """
+    global http_session
+    http_session = session
+    return http_session
+
+
+class ConcurrencyGovernor(object):
     """
-    Function to get the list of bouquets from the OpenWebif API
+    Governor of the requests to a receiver that keeps as many of them in
+    flight as the receiver copes with, and no more than max_rps requests
+    per second when given.
+
+    When adaptive the limit of requests in flight starts at 1 and follows an
+    AIMD scheme, like TCP congestion control: it grows by one every time a
+    limit's worth of requests succeed with a latency close to the lowest
+    seen, and it's halved when requests fail or take more than
+    latency_tolerance times the lowest latency, at most once per round
+    trip. Otherwise the limit is fixed at max_concurrency.
+    """
+    # Latencies below it are not considered slow, however low the lowest one
+    LATENCY_SLACK = 0.05
+
+    def __init__(self, max_concurrency, max_rps=None, adaptive=True,
+            latency_tolerance=2.0, backoff=0.5):
+        self.max_concurrency = max(1, max_concurrency)
+        self.adaptive = adaptive
+        self.limit = 1.0 if adaptive else float(self.max_concurrency)
+        self.settled = self.limit
+        self.min_interval = 1.0 / max_rps if max_rps else 0.0
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.next_start = 0.0
+        self.base_latency = None
+        self.last_decrease = None
+        self.stats = collections.Counter()
+
+    def acquire(self):
+        """
+        Waits for a free slot and for the rate limit. Returns the start time
+        to hand over to release.
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            now = timeit.default_timer()
+            start = max(now, self.next_start)
+            self.next_start = start + self.min_interval
+        if start > now:
+            sleep(start - now)
+        return timeit.default_timer()
+
+    def release(self, started, ok=True):
+        now = timeit.default_timer()
+        with self.condition:
+            self.in_flight -= 1
+            if self.adaptive:
+                self.adapt(now - started, ok, now)
+            self.stats['requests'] += 1
+            self.stats['errors'] += 0 if ok else 1
+            # Moving average of the limit, as it keeps probing around it
+            self.settled += 0.1 * (self.limit - self.settled)
+            self.condition.notify_all()
+
+    def adapt(self, latency, ok, now):
+        """
+        Adjusts the limit of requests in flight to the outcome of a request.
+        """
+        if ok and (self.base_latency is None or latency < self.base_latency):
+            self.base_latency = latency
+        slow = latency > max(self.base_latency * self.latency_tolerance,
+            self.base_latency + self.LATENCY_SLACK) if self.base_latency else False
+        if not ok or slow:
+            # The requests in flight were sent before the previous decrease
+            if self.last_decrease is None or now - self.last_decrease > latency:
+                self.limit = max(1.0, self.limit * self.backoff)
+                self.last_decrease = now
+                self.stats['decreases'] += 1
+        else:
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+
+    def call(self, function, *args, **kwargs):
+        """
+        Calls function within a slot of the governor.
+        """
+        started = self.acquire()
+        ok = False
+        try:
+            result = function(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            self.release(started, ok)
+
+    def summary(self):
+        return (u"Concurrency settled on {:.1f} requests in flight (limit {:.1f}, "
+            "up to {} in flight, {} decreases, {} requests, {} errors, lowest "
+            "latency {:.0f} ms)".format(self.settled, self.limit, self.max_in_flight,
+                self.stats['decreases'], self.stats['requests'], self.stats['errors'],
+                (self.base_latency or 0) * 1000))
+
+
+class EPGCache(object):
+    """
+    SQLite cache of the services of the bouquets and the EPG events of the
+    services of a receiver, so a run only refetches what is stale.
+
+    The services of a bouquet and the events of a service are stale when they
+    were fetched more than ttl seconds ago. The events of a service are also
+    stale when none of them ends in the future. Past events are expired on
+    every run.
+    """
+    def __init__(self, cache_dir, ttl, receiver):
+        import sqlite3
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'owi2plex.sqlite')
+        self.ttl = ttl
+        self.receiver = receiver
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS services ('
+                'receiver TEXT, bouquet_ref TEXT, services TEXT, fetched_at REAL, '
+                'PRIMARY KEY (receiver, bouquet_ref))')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS epg_services ('
+                'receiver TEXT, sref TEXT, fetched_at REAL, '
+                'PRIMARY KEY (receiver, sref))')
+            columns = [c[1] for c in self.db.execute('PRAGMA table_info(epg_services)')]
+            if 'window_begin' not in columns:
+                # The time window of the events was added after the first release
+                self.db.execute('ALTER TABLE epg_services ADD COLUMN window_begin REAL')
+                self.db.execute('ALTER TABLE epg_services ADD COLUMN window_end REAL')
+            if 'picon' not in columns:
+                self.db.execute('ALTER TABLE epg_services ADD COLUMN picon TEXT')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'receiver TEXT, sref TEXT, event_id INTEGER, position INTEGER, '
+                'end_timestamp INTEGER, event TEXT, fetched_at REAL, '
+                'PRIMARY KEY (receiver, sref, event_id))')
+
+    def isFresh(self, fetched_at, now):
+        return fetched_at is not None and now - fetched_at <= self.ttl
+
+    def coversWindow(self, window_begin, window_end, window, now):
+        """
+        Tells whether events fetched for the window (window_begin, window_end)
+        include all the events of window. None is an unbounded side, and the
+        events that ended before now have been expired anyway.
+        """
+        window = window or EPGWindow(None, None)
+        begin = max(window.begin or now, now)
+        covers_begin = window_begin is None or window_begin <= begin
+        covers_end = window_end is None or (
+            window.end is not None and window_end >= window.end)
+        return covers_begin and covers_end
+
+    def getServices(self, bouquet_ref, now=None):
+        """
+        Returns the cached services of a bouquet or None if they are stale.
+        """
+        now = now or datetime.now().timestamp()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT services, fetched_at FROM services '
+                'WHERE receiver = ? AND bouquet_ref = ?',
+                (self.receiver, bouquet_ref)).fetchone()
+        if row and self.isFresh(row[1], now):
+            self.stats['services_hits'] += 1
+            return json.loads(row[0])
+        self.stats['services_misses'] += 1
+        return None
+
+    def putServices(self, bouquet_ref, services, now=None):
+        now = now or datetime.now().timestamp()
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO services VALUES (?, ?, ?, ?)',
+                (self.receiver, bouquet_ref, json.dumps(services), now))
+
+    def getEvents(self, sref, now=None, window=None):
+        """
+        Returns the cached events of a service in their original order or
+        None if they are stale or were fetched for a narrower time window.
+        """
+        now = now or datetime.now().timestamp()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT fetched_at, window_begin, window_end, picon FROM epg_services '
+                'WHERE receiver = ? AND sref = ?',
+                (self.receiver, sref)).fetchone()
+            events = self.db.execute(
+                'SELECT event, end_timestamp FROM events '
+                'WHERE receiver = ? AND sref = ? ORDER BY position',
+                (self.receiver, sref)).fetchall()
+        if (row and self.isFresh(row[0], now) and any(e[1] > now for e in events)
+                and self.coversWindow(row[1], row[2], window, now)):
+            self.stats['epg_hits'] += 1
+            return ChannelEvents((Event(*json.loads(e[0])) for e in events), row[3])
+        self.stats['epg_misses'] += 1
+        return None
+
+    def getLastEvents(self, sref, now=None):
+        """
+        Returns the cached events of a service that haven't ended yet, however
+        long ago they were fetched, or None if there are none.
+        """
+        now = now or datetime.now().timestamp()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT picon FROM epg_services WHERE receiver = ? AND sref = ?',
+                (self.receiver, sref)).fetchone()
+            events = self.db.execute(
+                'SELECT event FROM events WHERE receiver = ? AND sref = ? '
+                'AND end_timestamp > ? ORDER BY position',
+                (self.receiver, sref, now)).fetchall()
+        if not events:
+            return None
+        self.stats['epg_reused'] += 1
+        return ChannelEvents((Event(*json.loads(e[0])) for e in events),
+            row[0] if row else None)
+
+    def putEvents(self, sref, events, now=None, window=None):
+        now = now or datetime.now().timestamp()
+        window = window or EPGWindow(None, None)
+        events = compactEvents(events)
+        rows = []
+        for position, event in enumerate(events):
+            rows.append((
+                self.receiver, sref,
+                event.id if event.id is not None else event.begin_timestamp,
+                position, event.begin_timestamp + event.duration * 60,
+                json.dumps(event.astuple()), now))
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM events WHERE receiver = ? AND sref = ?',
+                (self.receiver, sref))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.execute(
+                'INSERT OR REPLACE INTO epg_services '
+                '(receiver, sref, fetched_at, window_begin, window_end, picon) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (self.receiver, sref, now, window.begin, window.end, events.picon))
+
+    def expire(self, now=None):
+        """
+        Deletes the events that have already finished.
+        """
+        now = now or datetime.now().timestamp()
+        with self.lock, self.db:
+            expired = self.db.execute(
+                'DELETE FROM events WHERE receiver = ? AND end_timestamp <= ?',
+                (self.receiver, now)).rowcount
+        self.stats['expired_events'] += expired
+        return expired
+
+    def summary(self):
+        return (u"Cache {}: services {} hits / {} misses, EPG {} hits / {} misses, "
+            "{} expired events".format(
+                self.path, self.stats['services_hits'], self.stats['services_misses'],
+                self.stats['epg_hits'], self.stats['epg_misses'],
+                self.stats['expired_events']))
+
+    def close(self):
+        self.db.close()
+
+
+class FragmentCache(object):
+    """
+    SQLite cache of the serialised <channel> and <programme> elements of the
+    channels, keyed by a digest of everything they're rendered from, so the
+    channels whose events haven't changed since the previous run are spliced
+    into the XMLTV as they are instead of being rendered again.
+
+    New fragments are written in batches of up to BATCH_FRAGMENTS fragments
+    or BATCH_BYTES characters as they're rendered, all within a transaction
+    that's committed by flush, so only the digests of the fragments used are
+    kept in memory. Fragments that haven't been used for ttl seconds are
+    deleted by flush.
+    """
+    BATCH_FRAGMENTS = 256
+    BATCH_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, cache_dir, ttl):
+        import sqlite3
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, 'owi2plex.sqlite')
+        self.ttl = ttl
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pending_size = 0
+        self.used = set()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS fragments ('
+                'digest TEXT PRIMARY KEY, fragment TEXT, used_at REAL)')
+
+    def get(self, digest):
+        """
+        Returns the fragment rendered from the digest or None.
+        """
+        with self.lock:
+            fragment = self.pending.get(digest)
+            if fragment is None:
+                row = self.db.execute('SELECT fragment FROM fragments WHERE digest = ?',
+                    (digest,)).fetchone()
+                fragment = row[0] if row else None
+            if fragment is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['hits'] += 1
+                self.used.add(digest)
+        return fragment
+
+    def put(self, digest, fragment):
+        with self.lock:
+            self.pending[digest] = fragment
+            self.pending_size += len(fragment)
+            # The new fragments get the time of the flush as their last use
+            self.used.add(digest)
+            if (len(self.pending) >= self.BATCH_FRAGMENTS
+                    or self.pending_size >= self.BATCH_BYTES):
+                self.writePending()
+
+    def writePending(self):
+        """
+        Writes the pending fragments in the open transaction. Must be called
+        with the lock held.
+        """
+        self.db.executemany('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?)',
+            ((digest, fragment, datetime.now().timestamp())
+                for digest, fragment in self.pending.items()))
+        self.pending = {}
+        self.pending_size = 0
+
+    def flush(self, now=None):
+        """
+        Stores the new fragments, refreshes the last use of the ones that
+        have been used and deletes the ones left unused for ttl seconds.
+        """
+        now = now or datetime.now().timestamp()
+        with self.lock, self.db:
+            self.writePending()
+            self.db.executemany('UPDATE fragments SET used_at = ? WHERE digest = ?',
+                ((now, digest) for digest in self.used))
+            expired = self.db.execute('DELETE FROM fragments WHERE used_at < ?',
+                (now - self.ttl,)).rowcount
+            self.used = set()
+        self.stats['expired'] += expired
+
+    def hitRatio(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups else 0.0
+
+    def summary(self):
+        return u"Render cache {}: {} hits / {} misses ({:.0%}), {} expired fragments".format(
+            self.path, self.stats['hits'], self.stats['misses'], self.hitRatio(),
+            self.stats['expired'])
+
+    def close(self):
+        self.db.close()
+
+
+@contextlib.contextmanager
+def openAtomically(path, mode='w', **kwargs):
+    """
+    Function to open a temporary file next to path that's renamed into place
+    once it's been written and closed without errors, so readers never see
+    it partially written.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if 'b' not in mode:
+        kwargs.setdefault('encoding', 'utf-8')
+    temporary_file = tempfile.NamedTemporaryFile(mode, dir=directory, delete=False,
+        prefix='.{}.'.format(os.path.basename(path)), suffix='.tmp', **kwargs)
+    try:
+        with temporary_file:
+            yield temporary_file
+        os.chmod(temporary_file.name, 0o644)
+        os.replace(temporary_file.name, path)
+    except BaseException:
+        if os.path.exists(temporary_file.name):
+            os.remove(temporary_file.name)
+        raise
+
+
+def writeFileAtomically(path, text):
+    """
+    Function to write a text file through a temporary file renamed into place,
+    so readers never see it partially written.
+    """
+    with openAtomically(path) as f:
+        f.write(text)
+
+
+class PhaseProfiler(object):
+    """
+    Profiler of the phases of a run (see RunMetrics.phase) that collects the
+    cProfile stats of each phase, including the threads started during it
+    like the ones fetching the EPG, which are profiled until they end, and
+    the allocations made by each phase
+    from tracemalloc snapshots taken before and after it.
+
+    Every phase has one cProfile profiler, enabled each time the phase is
+    entered, so phases entered many times, like render and write, accumulate
+    their stats in it. From Python 3.12 it profiles every thread, and only
+    one profiler can be active at a time. Before that it only profiles the
+    calling thread, so the threads started during the phase get their own
+    profiles, which are merged into the stats of the phase once they end so
+    refreshing in serve mode doesn't keep piling them up. The after snapshot
+    of a phase is taken at most every snapshot_interval seconds since taking
+    one is slow. The render processes of -j aren't profiled.
+    """
+    # cProfile runs on sys.monitoring from 3.12, which sees every thread
+    PROFILE_THREADS = sys.version_info < (3, 12)
+
+    def __init__(self, profile_dir, top=20, snapshot_interval=1.0):
+        os.makedirs(profile_dir, exist_ok=True)
+        self.profile_dir = profile_dir
+        self.top = top
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.Lock()
+        self.profiles = collections.OrderedDict()
+        self.thread_hooks = {}
+        self.thread_profiles = {}
+        self.thread_stats = {}
+        self.snapshots = collections.OrderedDict()
+        self.snapshot_times = {}
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if name not in self.profiles:
+            self.profiles[name] = cProfile.Profile()
+            self.thread_profiles[name] = []
+            self.snapshots[name] = [tracemalloc.take_snapshot(), None]
+
+            def profileThread(*args):
+                thread_profile = cProfile.Profile()
+                with self.lock:
+                    self.thread_profiles[name].append(
+                        (threading.current_thread(), thread_profile))
+                thread_profile.enable()
+
+            self.thread_hooks[name] = profileThread
+        profile = self.profiles[name]
+
+        if self.PROFILE_THREADS:
+            threading.setprofile(self.thread_hooks[name])
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if self.PROFILE_THREADS:
+                threading.setprofile(None)
+            self.mergeThreads(name)
+            now = timeit.default_timer()
+            if now - self.snapshot_times.get(name, 0.0) >= self.snapshot_interval:
+                self.snapshots[name][1] = tracemalloc.take_snapshot()
+                self.snapshot_times[name] = timeit.default_timer()
+
+    def mergeThreads(self, name):
+        """
+        Merges the profiles of the threads of the phase that have ended into
+        its stats.
+        """
+        with self.lock:
+            thread_profiles = self.thread_profiles[name]
+            if not thread_profiles:
+                return
+            ended = [p for thread, p in thread_profiles if not thread.is_alive()]
+            thread_profiles[:] = [(thread, p) for thread, p in thread_profiles
+                if thread.is_alive()]
+        for thread_profile in ended:
+            if name in self.thread_stats:
+                self.thread_stats[name].add(thread_profile)
+            else:
+                self.thread_stats[name] = pstats.Stats(thread_profile,
+                    stream=io.StringIO())
+
+    def stats(self, name):
+        stats = pstats.Stats(self.profiles[name], stream=io.StringIO())
+        with self.lock:
+            running = [p for thread, p in self.thread_profiles[name]]
+        if name in self.thread_stats:
+            running.append(self.thread_stats[name])
+        if running:
+            stats.add(*running)
+        return stats
+
+    def allocations(self, name):
+        """
+        Returns the top allocations made by the phase that are still alive
+        at its end, as tracemalloc.StatisticDiff sorted by size.
+        """
+        before, after = self.snapshots[name]
+        if after is None:
+            return []
+        return after.compare_to(before, 'lineno')[:self.top]
+
+    def dump(self, metrics=None):
+        """
+        Writes to the profile directory, for every phase, its cProfile stats
+        (phase.prof, for pstats or snakeviz), its tracemalloc snapshot
+        (phase.tracemalloc, for tracemalloc.Snapshot.load) and a report.txt
+        of the hottest functions and the largest allocations of each phase.
+
+        returns:
+            - type: string
+            - desc: Path of the report.
+        """
+        report = io.StringIO()
+        phases = metrics.summary()['phases'] if metrics else {}
+        for name in self.profiles:
+            stats = self.stats(name)
+            stats.dump_stats(os.path.join(self.profile_dir, '{}.prof'.format(name)))
+            after = self.snapshots[name][1]
+            if after:
+                after.dump(os.path.join(self.profile_dir, '{}.tracemalloc'.format(name)))
+            report.write(u"== {} ({:.3f} s)\n\nHottest functions by own time:\n".format(
+                name, phases.get(name, 0.0)))
+            stats.stream = report
+            stats.sort_stats('tottime').print_stats(self.top)
+            report.write(u"Largest allocations alive at the end of the phase:\n")
+            for statistic in self.allocations(name):
+                report.write(u"  {}\n".format(statistic))
+            report.write(u"\n")
+        report_file = os.path.join(self.profile_dir, 'report.txt')
+        writeFileAtomically(report_file, report.getvalue())
+        return report_file
+
+
+class RunMetrics(object):
+    """
+    Instrumentation of a run: wall time of each phase, latency histogram,
+    bytes received and errors of the requests to OpenWebif and counts of
+    what's been retrieved and written. observeResponse is meant to be added
+    to the response hooks of the HTTP session. The phases are profiled too
+    when a profiler is given (see PhaseProfiler).
+    """
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, profiler=None):
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        self.started = datetime.now().timestamp()
+        self.start_time = timeit.default_timer()
+        self.phases = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self.requests = 0
+        self.request_errors = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * len(self.LATENCY_BUCKETS)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        profile = self.profiler.phase(name) if self.profiler else contextlib.nullcontext()
+        start = timeit.default_timer()
+        try:
+            with profile:
+                yield
+        finally:
+            elapsed = timeit.default_timer() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, value):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.counts[name] = value
+
+    def observeResponse(self, response, *args, **kwargs):
+        latency = response.elapsed.total_seconds()
+        if kwargs.get('stream'):
+            received = int(response.headers.get('Content-Length', 0))
+        else:
+            received = len(response.content)
+        with self.lock:
+            self.requests += 1
+            self.bytes_received += received
+            self.latency_sum += latency
+            if response.status_code >= 400:
+                self.request_errors += 1
+            for index, bucket in enumerate(self.LATENCY_BUCKETS):
+                if latency <= bucket:
+                    self.latency_buckets[index] += 1
+                    break
+        return response
+
+    def cumulativeLatencyBuckets(self):
+        cumulative = []
+        total = 0
+        for bucket, count in zip(self.LATENCY_BUCKETS, self.latency_buckets):
+            total += count
+            cumulative.append((bucket, total))
+        return cumulative
+
+    def summary(self):
+        """
+        Returns the metrics as a JSON serialisable dict.
+        """
+        with self.lock:
+            return collections.OrderedDict([
+                ('started', self.started),
+                ('duration', timeit.default_timer() - self.start_time),
+                ('phases', dict(self.phases)),
+                ('requests', collections.OrderedDict([
+                    ('count', self.requests),
+                    ('errors', self.request_errors),
+                    ('bytes_received', self.bytes_received),
+                    ('latency_sum', self.latency_sum),
+                    ('latency_buckets', collections.OrderedDict(
+                        (str(b), c) for b, c in self.cumulativeLatencyBuckets())),
+                ])),
+                ('counts', dict(self.counts)),
+                ('render_cache_hit_ratio', self.hitRatio('render_cache')),
+            ])
+
+    def hitRatio(self, prefix):
+        """
+        Returns the ratio of the prefix_hits to the prefix_hits and
+        prefix_misses counts, or None if nothing was looked up.
+        """
+        lookups = self.counts.get(prefix + '_hits', 0) + self.counts.get(prefix + '_misses', 0)
+        if not lookups:
+            return None
+        return self.counts.get(prefix + '_hits', 0) / lookups
+
+    def prometheus(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        summary = self.summary()
+        requests = summary['requests']
+        lines = [
+            '# HELP owi2plex_last_run_timestamp_seconds Start time of the last run.',
+            '# TYPE owi2plex_last_run_timestamp_seconds gauge',
+            'owi2plex_last_run_timestamp_seconds {}'.format(summary['started']),
+            '# HELP owi2plex_run_duration_seconds Wall time of the last run.',
+            '# TYPE owi2plex_run_duration_seconds gauge',
+            'owi2plex_run_duration_seconds {}'.format(summary['duration']),
+            '# HELP owi2plex_phase_duration_seconds Wall time of each phase of the last run.',
+            '# TYPE owi2plex_phase_duration_seconds gauge',
+        ]
+        for phase, duration in summary['phases'].items():
+            lines.append('owi2plex_phase_duration_seconds{{phase="{}"}} {}'.format(phase, duration))
+        lines += [
+            '# HELP owi2plex_request_duration_seconds Latency of the requests to OpenWebif.',
+            '# TYPE owi2plex_request_duration_seconds histogram',
+        ]
+        for bucket, count in requests['latency_buckets'].items():
+            lines.append('owi2plex_request_duration_seconds_bucket{{le="{}"}} {}'.format(bucket, count))
+        lines += [
+            'owi2plex_request_duration_seconds_bucket{{le="+Inf"}} {}'.format(requests['count']),
+            'owi2plex_request_duration_seconds_sum {}'.format(requests['latency_sum']),
+            'owi2plex_request_duration_seconds_count {}'.format(requests['count']),
+            '# HELP owi2plex_request_errors Requests to OpenWebif answered with an error.',
+            '# TYPE owi2plex_request_errors gauge',
+            'owi2plex_request_errors {}'.format(requests['errors']),
+            '# HELP owi2plex_received_bytes Bytes received from OpenWebif.',
+            '# TYPE owi2plex_received_bytes gauge',
+            'owi2plex_received_bytes {}'.format(requests['bytes_received']),
+        ]
+        for name, value in summary['counts'].items():
+            lines += [
+                '# TYPE owi2plex_{} gauge'.format(name),
+                'owi2plex_{} {}'.format(name, value),
+            ]
+        if summary['render_cache_hit_ratio'] is not None:
+            lines += [
+                '# HELP owi2plex_render_cache_hit_ratio Channels whose rendered XMLTV was reused.',
+                '# TYPE owi2plex_render_cache_hit_ratio gauge',
+                'owi2plex_render_cache_hit_ratio {}'.format(summary['render_cache_hit_ratio']),
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file=None, prometheus_file=None):
+        global logger
+        logger.info(u"Run metrics: {}".format(json.dumps(self.summary())))
+        if json_file:
+            writeFileAtomically(json_file, json.dumps(self.summary(), indent=2))
+        if prometheus_file:
+            writeFileAtomically(prometheus_file, self.prometheus())
+        if self.profiler:
+            logger.info(u"Profile report written to {}".format(self.profiler.dump(self)))
+
+
+def getBouquets(bouquet, api_root_url, list_bouquets, session=None):
+    """
+    Function to get the list of bouquets from the OpenWebif API, only the one
+    named bouquet, or the ones in it when it's a list of names, if given.
     
     return_type: dict
     return_model:
@@ -62,22 +879,44 @@ def getBouquets(bouquet, api_root_url, list_bouquets):
         }
     """
     global logger
+    session = session or getSession()
     result = collections.OrderedDict()
+    names = bouquet if isinstance(bouquet, (list, tuple, set)) else [bouquet]
     url = '{}/api/bouquets'.format(api_root_url)
     try:
-        bouquets_data = requests.get(url)
+        bouquets_data = session.get(url)
         bouquets = bouquets_data.json()['bouquets']
         for b in bouquets:
             if list_bouquets:
                 logger.info(u"Found bouquet: {}".format(b[1]))
-            if b[1] == bouquet or not bouquet:
+            if b[1] in names or not bouquet:
                 result[b[1]] = b[0]
     except Exception:
         raise
     return result
 
 
-def getBouquetsServices(bouquets, api_root_url):
+def listBouquets(receivers, list_services=False):
+    """
+    Function to print the bouquets of the receivers, along with their
+    services when list_services is set, without retrieving any EPG.
+    """
+    for receiver in receivers:
+        if len(receivers) > 1:
+            click.echo(u"{}:".format(receiver.name))
+        bouquets = getBouquets(receiver.bouquet, receiver.api_root_url, True)
+        services = collections.OrderedDict()
+        if list_services:
+            services = getBouquetsServices(bouquets, receiver.api_root_url)
+        for bouquet_name in bouquets:
+            click.echo(bouquet_name)
+            for service in services.get(bouquet_name, []):
+                if service['pos']:
+                    click.echo(u"  {:>4}. {} ({})".format(service['pos'],
+                        unescape(service['servicename']), service['program']))
+
+
+def getBouquetsServices(bouquets, api_root_url, session=None, cache=None):
     """
     Function to return the list of services (channels) for each bouquet in the
     bouquets param
@@ -85,6 +924,8 @@ def getBouquetsServices(bouquets, api_root_url):
     params:
         - boutquets: [bouquet_obj_1, bouquet_obj_2, ...]
         - api_root_url: Root URL of the OpenWebif server
+        - session: HTTP session to use instead of the shared one
+        - cache: EPGCache to get the services from when they are fresh
     returns:
         - type: dict
         - model:
@@ -94,24 +935,578 @@ def getBouquetsServices(bouquets, api_root_url):
                 "bouquet_name_n": [svc_1_obj, svc_2_obj, ..., svc_n_obj]
             }
     """
+    session = session or getSession()
     services = collections.OrderedDict()
     try:
         for bouquet_name, bouquet_svc_ref in bouquets.items():
+            if cache:
+                services[bouquet_name] = cache.getServices(bouquet_svc_ref)
+                if services[bouquet_name] is not None:
+                    continue
             url = '{}/api/getservices?sRef={}'.format(api_root_url, bouquet_svc_ref)
-            services_data = requests.get(url)
+            services_data = session.get(url)
             services[bouquet_name] = services_data.json()['services']
+            if cache:
+                cache.putServices(bouquet_svc_ref, services[bouquet_name])
     except Exception:
         raise
     return services
 
 
-def getEPGs(bouquets_services, api_root_url):
+class Event(object):
+    """
+    Compact record of an EPG event with only the fields owi2plex uses, as the
+    event dicts of OpenWebif repeat the service reference, name and picon in
+    every event. The fields can also be read like the keys of the event
+    dicts, e.g. event['title'].
+    """
+    __slots__ = ('id', 'begin_timestamp', 'duration', 'title', 'shortdesc',
+        'longdesc')
+
+    def __init__(self, id, begin_timestamp, duration, title, shortdesc, longdesc):
+        self.id = id
+        self.begin_timestamp = begin_timestamp
+        self.duration = duration
+        self.title = title
+        self.shortdesc = shortdesc
+        self.longdesc = longdesc
+
+    @classmethod
+    def fromJSON(cls, event):
+        """
+        Returns the Event of an event dict of the OpenWebif API. The bulk
+        endpoints report the duration in seconds only.
+        """
+        duration = event.get('duration')
+        if duration is None:
+            duration = event.get('duration_sec', 0) // 60
+        # Titles repeat all over the guide, so a single copy of each is kept
+        return cls(event.get('id'), event['begin_timestamp'], duration,
+            sys.intern(event['title']), event.get('shortdesc', ''),
+            event.get('longdesc', ''))
+
+    def astuple(self):
+        return EVENT_FIELDS(self)
+
+    # Reading the fields by key is in the hot path of the rendering, so it's
+    # left to the C implementation of attribute access. Missing fields raise
+    # AttributeError instead of KeyError.
+    __getitem__ = object.__getattribute__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __eq__(self, other):
+        return isinstance(other, Event) and self.astuple() == other.astuple()
+
+    def __repr__(self):
+        return 'Event{}'.format(self.astuple())
+
+
+EVENT_FIELDS = operator.attrgetter(*Event.__slots__)
+
+
+class ChannelEvents(list):
+    """
+    Events of a channel, along with the picon they all share.
+    """
+    def __init__(self, events=(), picon=None):
+        super(ChannelEvents, self).__init__(events)
+        self.picon = picon
+
+
+def channelPicon(events):
+    """
+    Function to get the picon of a channel from its events, which are event
+    dicts of the OpenWebif API when they don't come from compactEvents.
+    """
+    picon = getattr(events, 'picon', None)
+    if picon is None and events and isinstance(events[0], dict):
+        picon = events[0].get('picon')
+    return picon
+
+
+def compactEvents(events, picon=None):
+    """
+    Function to reduce the event dicts of the OpenWebif API to Events as
+    they're parsed, keeping the picon once for the whole channel.
+
+    returns:
+        - type: ChannelEvents
+        - model: [ Event_1, Event_2, ...] with the picon attribute
+    """
+    picon = picon or getattr(events, 'picon', None)
+    result = ChannelEvents()
+    for event in events:
+        if not isinstance(event, Event):
+            picon = picon or event.get('picon')
+            event = Event.fromJSON(event)
+        result.append(event)
+    result.picon = picon
+    return result
+
+
+class JSONStream(object):
+    """
+    Incremental reader of a JSON document that arrives in chunks of bytes.
+    Only the text that hasn't been decoded yet is kept in memory.
+    """
+    WHITESPACE = ' \t\n\r'
+    NUMBER_CHARS = '0123456789.eE+-'
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        """
+        Appends the next chunk to the buffer. Returns False at the end.
+        """
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.text_decoder.decode(b'', final=True)
+        else:
+            text = self.text_decoder.decode(chunk)
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skips the whitespace and returns the next character.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                raise ValueError(u"Unexpected end of the JSON document")
+
+    def expect(self, chars):
+        """
+        Consumes the next character, which must be one of chars.
+        """
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(u"Expected one of {!r} in the JSON document, found {!r}".format(
+                chars, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes the next JSON value, reading chunks until it's complete.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number cut by the end of the chunk decodes fine, so a value
+                # is only complete when it's followed by something else
+                if self.eof or (end < len(self.buffer)
+                        and self.buffer[end] not in self.NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read()
+
+    def drain(self):
+        while self.read():
+            self.pos = len(self.buffer)
+
+
+def iterJSONArray(response, key, chunk_size=65536):
+    """
+    Function to parse the array under key of the JSON object in a streamed
+    response incrementally, yielding its items as they're decoded so the
+    whole payload is never held in memory. The rest of the members of the
+    object are skipped.
+    """
+    stream = JSONStream(response.iter_content(chunk_size))
+    stream.expect('{')
+    if stream.peek() != '}':
+        while True:
+            name = stream.value()
+            stream.expect(':')
+            if name == key:
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.pos += 1
+                else:
+                    while True:
+                        yield stream.value()
+                        if stream.expect(',]') == ']':
+                            break
+                # Reading to the end releases the connection back to the pool
+                stream.drain()
+                return
+            stream.value()
+            if stream.expect(',}') == '}':
+                break
+    raise ValueError(u"No {} in the response".format(key))
+
+
+EPGWindow = collections.namedtuple('EPGWindow', ['begin', 'end'])
+
+
+def makeEPGWindow(from_time=None, days=None, now=None):
+    """
+    Function to get the time window of the EPG from the --from and --days
+    options. The window starts at from_time, or now if it isn't given, and
+    lasts days. Without days it's open ended.
+
+    returns:
+        - type: EPGWindow or None when neither option is given
+        - model: EPGWindow(begin_timestamp, end_timestamp_or_None)
+    """
+    if from_time is None and days is None:
+        return None
+    begin = from_time.timestamp() if from_time else (now or datetime.now().timestamp())
+    end = begin + days * 86400 if days is not None else None
+    return EPGWindow(int(begin), int(end) if end is not None else None)
+
+
+def windowQuery(window):
+    """
+    Function to get the query string parameters of the EPG endpoints that
+    limit the events to the window. OpenWebif hands them over to enigma2's
+    EPG lookup, where endTime is the number of minutes after time.
+    """
+    if not window:
+        return u''
+    query = u'&time={}'.format(window.begin)
+    if window.end is not None:
+        query += u'&endTime={}'.format((window.end - window.begin + 59) // 60)
+    return query
+
+
+def filterEvents(events, window):
+    """
+    Function to drop the events that end before the window begins or begin
+    after it ends, for receivers that ignore the time parameters. The events
+    left are sorted by begin time (see EventIndex).
+    """
+    if not window:
+        return events
+    return ChannelEvents(EventIndex(events).range(window.begin, window.end),
+        channelPicon(events))
+
+
+def eventEnd(event):
+    return event['begin_timestamp'] + event['duration'] * 60
+
+
+# Sorting by begin and duration is sorting by begin and end
+EVENT_ORDER = operator.itemgetter('begin_timestamp', 'duration')
+# Events with the same key are duplicates, whatever their ids
+EVENT_KEY = operator.itemgetter('begin_timestamp', 'duration', 'title',
+    'shortdesc', 'longdesc')
+
+
+class EventIndex(object):
+    """
+    Events of a channel sorted by begin time, along with the running maximum
+    of their end times, so the events in a time range are found with a binary
+    search even when some of them overlap.
+    """
+    def __init__(self, events):
+        self.events = sorted(events, key=EVENT_ORDER)
+        self.begins = [event['begin_timestamp'] for event in self.events]
+        self.max_ends = list(itertools.accumulate(
+            (eventEnd(event) for event in self.events), max))
+
+    def __len__(self):
+        return len(self.events)
+
+    def range(self, begin=None, end=None):
+        """
+        Returns the events that end after begin and begin before end, in
+        order. Either end of the range can be left open with None.
+        """
+        first = 0 if begin is None else bisect.bisect_right(self.max_ends, begin)
+        last = len(self.events) if end is None else bisect.bisect_left(self.begins, end)
+        if begin is None:
+            return self.events[first:last]
+        return [event for event in self.events[first:last] if eventEnd(event) > begin]
+
+
+OVERLAP_POLICIES = ('keep', 'trim', 'drop')
+
+# Title of the events filling the gaps of the EPG (see normaliseEvents)
+GAP_TITLE = u'No Information'
+
+
+def withDuration(event, duration):
+    if isinstance(event, Event):
+        return Event(event.id, event.begin_timestamp, duration, event.title,
+            event.shortdesc, event.longdesc)
+    return dict(event, duration=duration)
+
+
+def normaliseEvents(events, overlaps='keep', fill_gaps=None, stats=None):
+    """
+    Function to sort the events of a channel by begin time and drop the
+    exact duplicates, that is the events with the same time, duration and
+    texts.
+
+    Events that begin before the previous one ends are left as they are with
+    the 'keep' overlaps policy, cut short at the begin of the next one with
+    'trim', dropped if that leaves them without a minute, and dropped with
+    'drop'. With fill_gaps the gaps between events of at least that many
+    minutes are filled with an event titled GAP_TITLE.
+
+    The number of duplicates, overlaps and gaps found are added to the stats
+    Counter when given.
+
+    returns:
+        - type: ChannelEvents
+    """
+    stats = stats if stats is not None else collections.Counter()
+    result = ChannelEvents(picon=channelPicon(events))
+    seen = set()
+    # Latest end of the events kept so far
+    latest_end = None
+    for event in sorted(events, key=EVENT_ORDER):
+        key = EVENT_KEY(event)
+        if key in seen:
+            stats['duplicates'] += 1
+            continue
+        seen.add(key)
+        begin = key[0]
+        if latest_end is not None and begin < latest_end:
+            stats['overlaps'] += 1
+            if overlaps == 'drop':
+                continue
+            if overlaps == 'trim':
+                previous = result.pop()
+                duration = (begin - previous['begin_timestamp']) // 60
+                if duration > 0:
+                    result.append(withDuration(previous, duration))
+        elif (fill_gaps and latest_end is not None
+                and begin - latest_end >= fill_gaps * 60):
+            stats['gaps'] += 1
+            result.append(Event(None, latest_end, (begin - latest_end) // 60,
+                GAP_TITLE, u'', u''))
+        result.append(event)
+        end = begin + key[1] * 60
+        if overlaps == 'trim' or latest_end is None or end > latest_end:
+            latest_end = end
+    return result
+
+
+def normaliseEPG(epg, overlaps='keep', fill_gaps=None, metrics=None):
+    """
+    Function to normalise the events of every channel of the EPG (see
+    normaliseEvents), logging and counting in metrics the duplicates,
+    overlaps and gaps found.
+
+    returns:
+        - type: dict
+        - model: {"program_id": ChannelEvents, ...}
+    """
+    global logger
+    stats = collections.Counter()
+    normalised = collections.OrderedDict((program, normaliseEvents(events,
+        overlaps, fill_gaps, stats)) for program, events in epg.items())
+    logger.info(u"Dropped {} duplicated events, found {} overlapping events "
+        "({}) and filled {} gaps".format(stats['duplicates'], stats['overlaps'],
+            overlaps, stats['gaps']))
+    if metrics:
+        metrics.count('duplicate_events', stats['duplicates'])
+        metrics.count('overlapping_events', stats['overlaps'])
+        metrics.count('filled_gaps', stats['gaps'])
+    return normalised
+
+
+def getServiceEPG(service, api_root_url, session=None, window=None):
+    """
+    Function to get the EPG of a single service from the OpenWebif API,
+    limited to the time window when one is given. The response is parsed as
+    it arrives and reduced to compact events (see compactEvents).
+
+    returns:
+        - type: ChannelEvents
+        - model: [ Event_1, Event_2, ...]
+    """
+    global logger
+    session = session or getSession()
+    url = u'{}/api/epgservice?sRef={}{}'.format(api_root_url,
+        service['servicereference'], windowQuery(window))
+    logger.info(u"Getting EPG for service %s. %s (%s) from %s", service['pos'],
+        service['servicename'], service['program'], url)
+    with session.get(url, stream=True) as service_epg_data:
+        return compactEvents(iterJSONArray(service_epg_data, 'events'))
+
+
+def serviceRefKey(service_reference):
+    """
+    Function to normalise a service reference so the ones returned in the
+    events of the bulk endpoints match the ones in the services lists.
+    """
+    return service_reference.rstrip(':').upper()
+
+
+# Days of EPG asked to the bulk endpoint when the window doesn't end
+BULK_EPG_DAYS = 14
+
+# How much earlier than the rest of its bouquet the events of a service can
+# end in a bulk response before they're taken as truncated
+TRUNCATION_SLACK = 6 * 3600
+
+
+def bulkWindow(window=None, now=None):
+    """
+    Function to get the time window asked to the bulk endpoint, which must
+    always be explicit: without an end OpenWebif only returns the current
+    event of each service.
+
+    returns:
+        - type: EPGWindow
+    """
+    begin = window.begin if window else int(now or datetime.now().timestamp())
+    end = window.end if window and window.end is not None else None
+    return EPGWindow(begin, end if end is not None else begin + BULK_EPG_DAYS * 86400)
+
+
+def truncatedServices(bouquet_epg, window):
+    """
+    Function to find the services whose events in a bulk response look
+    truncated: the ones with a single event that ends before the window,
+    like when the receiver only returns the current event, and the ones
+    whose events end more than TRUNCATION_SLACK before the median of the
+    bouquet.
+
+    returns:
+        - type: set
+        - desc: Keys of the truncated services in bouquet_epg.
+    """
+    horizons = dict((key, channelHorizon(events)) for key, events in bouquet_epg.items())
+    if not horizons:
+        return set()
+    median = statistics.median(horizons.values())
+    return set(key for key, horizon in horizons.items()
+        if (len(bouquet_epg[key]) <= 1 and horizon < window.end)
+        or horizon < min(median, window.end) - TRUNCATION_SLACK)
+
+
+def getBouquetEPG(bouquet_svc_ref, api_root_url, session=None, window=None):
+    """
+    Function to get the EPG of all the services of a bouquet with a single
+    request to the /api/epgbouquet endpoint of the OpenWebif API, limited to
+    the time window, or the next BULK_EPG_DAYS when it's open ended (see
+    bulkWindow).
+
+    returns:
+        - type: dict
+        - model:
+            {
+                "sRef_key_1": ChannelEvents([ Event_1, Event_2, ...]),
+                ...,
+                "sRef_key_n": ChannelEvents([ Event_1, Event_2, ...])
+            }
+    """
+    global logger
+    session = session or getSession()
+    url = u'{}/api/epgbouquet?bRef={}{}'.format(api_root_url, bouquet_svc_ref,
+        windowQuery(bulkWindow(window)))
+    logger.info(u"Getting EPG for bouquet {}".format(url))
+    bouquet_epg = collections.OrderedDict()
+    with session.get(url, stream=True) as bouquet_epg_data:
+        try:
+            for event in iterJSONArray(bouquet_epg_data, 'events'):
+                key = serviceRefKey(event['sref'])
+                if key not in bouquet_epg:
+                    bouquet_epg[key] = ChannelEvents(picon=event.get('picon'))
+                bouquet_epg[key].append(Event.fromJSON(event))
+        except ValueError as e:
+            raise ValueError(u"No EPG returned for bouquet {}: {}".format(
+                bouquet_svc_ref, e))
+    return bouquet_epg
+
+
+def planEPGFetch(bouquets_services):
+    """
+    Function to plan the EPG requests so each service is only requested once,
+    even when it's in several bouquets. Every service is assigned to the
+    first bouquet it appears in.
+
+    returns:
+        - type: tuple
+        - model:
+            (
+                {
+                    "bouquet_name_1": [svc_1_obj, svc_2_obj, ..., svc_n_obj],
+                    ...
+                    "bouquet_name_n": [svc_1_obj, svc_2_obj, ..., svc_n_obj]
+                },
+                number_of_duplicated_services
+            )
+    """
+    plan = collections.OrderedDict()
+    planned = set()
+    duplicates = 0
+    for bouquet_name, services in bouquets_services.items():
+        plan[bouquet_name] = []
+        for service in services:
+            if service['pos']:
+                if service['servicereference'] in planned:
+                    duplicates += 1
+                else:
+                    planned.add(service['servicereference'])
+                    plan[bouquet_name].append(service)
+    return plan, duplicates
+
+
+def getEPGs(bouquets_services, api_root_url, max_workers=1, failures=None,
+        session=None, fetch_mode='service', bouquets=None, cache=None,
+        window=None, governor=None):
     """
     Function to get the EPGs for the services in the bouquet_services param.
+    Services in several bouquets are only requested once (see planEPGFetch).
+    Up to max_workers requests are kept in flight at the same time. A service
+    whose EPG can't be retrieved doesn't abort the run: it gets an empty list
+    of events and the error is logged and added to the failures dict.
+
+    In the 'bouquet' fetch mode the EPG of each bouquet is retrieved with a
+    single request (see getBouquetEPG). The services that are missing from
+    the bulk response or whose events in it look truncated (see
+    truncatedServices), or all of them if the bulk endpoint isn't available,
+    are then retrieved one by one.
+
+    When a cache is given the services with fresh events in it aren't
+    requested, and the events of the rest are stored in it as soon as they're
+    retrieved. The cache is the checkpoint of the run: when a run is
+    interrupted or some services fail, the next one only requests the
+    services missing from it.
+
+    When a time window is given it's passed on to OpenWebif and the events
+    outside it are dropped before they're returned (see filterEvents).
+
+    When a governor is given the requests go through it, so it decides how
+    many of the max_workers are in flight (see ConcurrencyGovernor).
 
     params:
         - bouquet_services: [svc_obj_1, svc_obj_2, ...]
         - api_root_url: Root URL of the OpenWebif server
+        - max_workers: Maximum number of concurrent requests
+        - failures: Optional dict filled with {"program_id": exception}
+        - session: HTTP session to use instead of the shared one
+        - fetch_mode: 'service' or 'bouquet'
+        - bouquets: {"bouquet_name": "sRef"} as returned by getBouquets.
+          Required by the 'bouquet' fetch mode.
+        - cache: EPGCache to get the events from when they are fresh
+        - window: EPGWindow the events are limited to
+        - governor: ConcurrencyGovernor of the requests to the receiver
     returns:
         - type: dict
         - model:
@@ -122,98 +1517,210 @@ def getEPGs(bouquets_services, api_root_url):
             }
     """
     global logger
-    epg = {}
-    for _, services in bouquets_services.items():
-        for service in services:
-            if service['pos']:
-                url = u'{}/api/epgservice?sRef={}'.format(api_root_url, service['servicereference'])
-                debug_message = u"Getting EPG for service {}. {} ({}) from {}".format(
-                    service['pos'], service['servicename'], service['program'],
-                    url)
-                logger.info(debug_message)
+    session = session or getSession()
+    epg = collections.OrderedDict()
+    plan, duplicates = planEPGFetch(bouquets_services)
+    logger.info(u"Planned EPG for {} services, saving {} duplicated requests".format(
+        sum(len(services) for services in plan.values()), duplicates))
+    cached = {}
+    if cache:
+        for _, services in plan.items():
+            for service in services:
+                events = cache.getEvents(service['servicereference'], window=window)
+                if events is not None:
+                    cached[service['servicereference']] = events
+
+    def submit(executor, function, *args):
+        if governor:
+            return executor.submit(governor.call, function, *args)
+        return executor.submit(function, *args)
+
+    def fetchService(service):
+        events = getServiceEPG(service, api_root_url, session, window)
+        if cache:
+            cache.putEvents(service['servicereference'], filterEvents(events, window),
+                window=window)
+        return events
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        bouquet_fetches = collections.OrderedDict()
+        if fetch_mode == 'bouquet':
+            for bouquet_name, services in plan.items():
+                missing = [service for service in services
+                    if service['servicereference'] not in cached]
+                if missing and bouquets and bouquets.get(bouquet_name):
+                    bouquet_fetches[bouquet_name] = submit(executor,
+                        getBouquetEPG, bouquets[bouquet_name], api_root_url, session,
+                        window)
+
+        fetches = []
+        for bouquet_name, services in plan.items():
+            bouquet_epg = {}
+            if bouquet_name in bouquet_fetches:
                 try:
-                    service_epg_data = requests.get(url)
-                    epg[service['program']] = service_epg_data.json()['events']
-                except Exception:
-                    raise
+                    bouquet_epg = bouquet_fetches[bouquet_name].result()
+                    truncated = truncatedServices(bouquet_epg, bulkWindow(window))
+                    if truncated:
+                        logger.warning(u"The EPG of {} services of bouquet {} looks "
+                            "truncated, falling back to per service requests".format(
+                                len(truncated), bouquet_name))
+                        for key in truncated:
+                            del bouquet_epg[key]
+                except Exception as e:
+                    logger.warning(u"Unable to get EPG for bouquet {}, falling "
+                        "back to per service requests: {}".format(bouquet_name, e))
+            for service in services:
+                events = cached.get(service['servicereference'])
+                is_stored = events is not None
+                if not is_stored:
+                    events = bouquet_epg.get(serviceRefKey(service['servicereference']))
+                if events:
+                    fetch = Future()
+                    fetch.set_result(events)
+                else:
+                    fetch = submit(executor, fetchService, service)
+                    is_stored = True
+                fetches.append((service, fetch, is_stored))
+        # Results are collected in submission order to keep the output stable
+        dropped = 0
+        for service, fetch, is_stored in fetches:
+            try:
+                events = fetch.result()
+                epg[service['program']] = filterEvents(events, window)
+                dropped += len(events) - len(epg[service['program']])
+                if cache and not is_stored:
+                    cache.putEvents(service['servicereference'], epg[service['program']],
+                        window=window)
+            except Exception as e:
+                logger.error(u"Unable to get EPG for service {} ({}): {}".format(
+                    service['servicename'], service['servicereference'], e))
+                epg[service['program']] = []
+                if failures is not None:
+                    failures[service['program']] = e
+    if window:
+        logger.info(u"Dropped {} events outside the EPG window".format(dropped))
     return epg
 
 
-def getOffset(api_root_url):
-    global logger
-    now = datetime.timestamp(datetime.now())
-    offset = (datetime.fromtimestamp(now) - datetime.utcfromtimestamp(now)).total_seconds()
-    hours = round(offset / 3600)
-    minutes = (offset - (hours * 3600))
-    tzo = "{:+05}".format(int(hours * 100 + (round(minutes / 900) * 900 / 60)))
+@functools.lru_cache(maxsize=None)
+def formatUTCOffset(offset):
+    """
+    Function to format an offset from UTC in seconds as used by XMLTV, e.g.
+    +0100 or -0330. There are only a few distinct offsets so all are cached.
+    """
+    sign = '-' if offset < 0 else '+'
+    minutes = abs(offset) // 60
+    return '{}{:02}{:02}'.format(sign, minutes // 60, minutes % 60)
 
-    logger.info("Setting TZ Offset from UTC to {}".format(tzo))
-    return tzo
 
+@functools.lru_cache(maxsize=65536)
+def formatXMLTVTime(timestamp):
+    """
+    Function to format a timestamp as an XMLTV date in local time, with the
+    offset from UTC in force at that instant so guides crossing a daylight
+    saving time change get the right offsets. Programmes across channels
+    start at the same few times, so the results are memoised.
+    """
+    local_time = localtime(timestamp)
+    return '%04d%02d%02d%02d%02d%02d %s' % (
+        local_time.tm_year, local_time.tm_mon, local_time.tm_mday,
+        local_time.tm_hour, local_time.tm_min, local_time.tm_sec,
+        formatUTCOffset(local_time.tm_gmtoff))
 
-def addChannels2XML(xmltv, bouquets_services, epg, api_root_url, continuous_numbering):
+
+def iterChannelPositions(bouquets_services, continuous_numbering):
     """
-    Function to add the list of services/channels to the resultant XML object.
+    Function to iterate the services/channels that are written to the XMLTV
+    in bouquet order along with the number they get.
 
     returns:
-        - type: lxml.etree
+        - type: generator of (svc_obj, position) tuples
     """
     continuous_service_position = 1
     for _, services in bouquets_services.items():
         for service in services:
             if service['pos']:
-                channel = etree.SubElement(xmltv, 'channel')
-                channel.attrib['id'] = '{}'.format(service['program'])
-                etree.SubElement(channel, 'display-name').text = unescape(service['servicename'])
                 if (continuous_numbering == True):
-                    etree.SubElement(channel, 'display-name').text = str(continuous_service_position)
+                    yield service, continuous_service_position
                 else:
-                    etree.SubElement(channel, 'display-name').text = str(service['pos'])
-                if epg[service['program']]:
-                    first_event = epg[service['program']][0]
-                    channel_picon = etree.SubElement(channel, 'icon')
-                    channel_picon.attrib['src'] = '{}{}'.format(api_root_url, first_event['picon'])
+                    yield service, service['pos']
             continuous_service_position += 1
+
+
+def addChannel2XML(xmltv, service, position, epg, api_root_url):
+    """
+    Function to add a service/channel to the resultant XML object.
+
+    returns:
+        - type: lxml.etree
+    """
+    from lxml import etree
+    channel = etree.SubElement(xmltv, 'channel')
+    channel.attrib['id'] = '{}'.format(service['program'])
+    etree.SubElement(channel, 'display-name').text = unescape(service['servicename'])
+    etree.SubElement(channel, 'display-name').text = str(position)
+    picon = channelPicon(epg[service['program']])
+    if epg[service['program']] and picon:
+        channel_picon = etree.SubElement(channel, 'icon')
+        if not picon.startswith(('http://', 'https://')):
+            picon = '{}{}'.format(api_root_url, picon)
+        channel_picon.attrib['src'] = picon
+    return xmltv
+
+
+def addChannels2XML(xmltv, bouquets_services, epg, api_root_url, continuous_numbering):
+    """
+    Function to add the list of services/channels to the resultant XML object.
+
+    returns:
+        - type: lxml.etree
+    """
+    for service, position in iterChannelPositions(bouquets_services, continuous_numbering):
+        xmltv = addChannel2XML(xmltv, service, position, epg, api_root_url)
     return xmltv
 
 
-def addCategories2Programme(title, programme, event, overrides):
+def addCategories2Programme(title, programme, event_text, overrides):
     """
     Function to add the catergories to a program. Returns the XML program object
-    with the cateogry added.
+    with the cateogry added. The categories of the EPG come from the parsed
+    event_text (see parseEventText).
 
     returns:
         - type: lxml.etree
     """
+    from lxml import etree
+    for category in programmeCategories(title, event_text, overrides):
+        programme_category = etree.SubElement(programme, 'category')
+        programme_category.attrib['lang'] = 'en'
+        programme_category.text = '{}'.format(category)
+
+    return programme
+
+
+def programmeCategories(title, event_text, overrides):
+    """
+    Function to get the categories of a program: the ones of the overrides
+    matching its title if any, otherwise the ones of the EPG.
+
+    returns:
+        - type: list
+    """
     category_overrides = []
-    categories = re.search(r'^\[(?P<C1>[\w\s]+)[\.\s]*(?P<C2>[\w\s]+)*\]', event['shortdesc'])
 
     if overrides:
-        for pattern, override_categories in overrides.items():
-            if pattern in title.upper():
-                for category in override_categories:
-                    category_overrides.append(category) 
+        category_overrides = overrides.match(title)
 
     if len(category_overrides) > 0:
-        for cat_override in category_overrides:
-            programme_category = etree.SubElement(programme, 'category')
-            programme_category.attrib['lang'] = 'en'
-            programme_category.text = '{}'.format(cat_override)
-    elif categories:
-        for category in categories.groupdict().values(): 
-            if category:
-                programme_category = etree.SubElement(programme, 'category')
-                programme_category.attrib['lang'] = 'en'
-                programme_category.text = '{}'.format(category)
-
-    return programme
+        return list(category_overrides)
+    return list(event_text.categories)
 
 def parseSEP(text):
     """
     Function to parse the Seasson.Episode.Part numbers
     """ 
     global logger
-    logger.debug("ParsingSEP: {}".format(text))
+    logger.debug("ParsingSEP: %s", text)
     S = ''
     E = ''
     P = ''
@@ -221,8 +1728,8 @@ def parseSEP(text):
     match = None
     is_premiere = False
 
-    c4_style = re.search(r'(?:S(?P<S>\d+)(?:\/|\s)*)?(?:Ep|E)\s*(?P<E>\d+)(?:\/(?P<P>\d+))?', text)
-    bbc_style = re.search(r'^(?P<E>\d+)\/(?P<P>\d+)\.', text)
+    c4_style = C4_STYLE_SEP_RE.search(text)
+    bbc_style = BBC_STYLE_SEP_RE.search(text)
     if bbc_style:
         match = bbc_style
     elif c4_style:
@@ -242,11 +1749,78 @@ def parseSEP(text):
                 is_premiere = True
         if 'P' in group_names:
             P = '{}'.format(int(match.group('P')) - 1 if match.group('P') else '')
-    logger.debug("ParseSEP ==>{}: {}.{}.{}".format(is_a_match, S,E,P))    
+    logger.debug("ParseSEP ==>%s: %s.%s.%s", is_a_match, S, E, P)
     return is_a_match, '{}.{}.{}'.format(S, E, P), is_premiere
 
 
-def addSeriesInfo2Programme(programme, event, air_dt):
+EventText = collections.namedtuple('EventText', [
+    'title', 'desc', 'subtitle', 'categories', 'match_epnum', 'epnum',
+    'is_premiere', 'original_air_date', 'original_air_dt', 'credits'])
+
+
+@functools.lru_cache(maxsize=16384)
+def parseEventText(title, shortdesc, longdesc):
+    """
+    Function to parse everything the XMLTV needs from the texts of an event:
+    cleaned title, description, subtitle, categories, Season.Episode.Part,
+    original air date and movie credits. The same texts are repeated across
+    the airings of a series, so the results are memoised.
+
+    returns:
+        - type: EventText
+    """
+    subtitle = None
+    if longdesc == '':
+        desc = unescape(shortdesc)
+    else:
+        desc = unescape(longdesc)
+        subtitle = SUBTITLE_SERIES_RE.sub('', SUBTITLE_CATEGORIES_RE.sub('', shortdesc))
+        subtitle = unescape(subtitle) if len(subtitle) > 0 else None
+    if shortdesc == '':
+        shortdesc = longdesc
+
+    # Get the title and remove the word NEW if present
+    clean_title = unescape(title).replace('New: ', '')
+
+    categories = CATEGORIES_RE.search(shortdesc)
+    if categories:
+        categories = tuple(c for c in categories.groupdict().values() if c)
+    match_epnum, epnum, is_premiere = parseSEP(shortdesc)
+
+    original_air_date = ORIGINAL_AIR_DATE_RE.search(shortdesc)
+    original_air_dt = None
+    if original_air_date:
+        original_air_date = "{}-{}-{}".format(
+            original_air_date.group(3),
+            original_air_date.group(2),
+            original_air_date.group(1))
+        try:
+            original_air_dt = datetime.strptime(original_air_date, '%Y-%m-%d').date()
+        except ValueError:
+            # The orinal air date cannot be parse and will therefore be ignored
+            pass
+
+    cast = longdesc.split('\n', 2)
+    credits = None
+    if len(cast) > 2:
+        credits = (cast[1], tuple(cast[2][:-1].split('\n')))
+
+    return EventText(clean_title, desc, subtitle, categories or (), match_epnum,
+        epnum, is_premiere, original_air_date, original_air_dt, credits)
+
+
+def logEventTextCacheInfo():
+    global logger
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    cache_info = parseEventText.cache_info()
+    lookups = cache_info.hits + cache_info.misses
+    logger.debug(u"Event text parser cache: {} hits, {} misses ({:.1%} hit rate), "
+        "{} entries".format(cache_info.hits, cache_info.misses,
+        cache_info.hits / lookups if lookups else 0, cache_info.currsize))
+
+
+def addSeriesInfo2Programme(programme, event_text, air_dt):
     """
     Function to add Information to programs with the Categories Series or Show
     relating to the episode number or original air date.
@@ -254,8 +1828,10 @@ def addSeriesInfo2Programme(programme, event, air_dt):
     returns:
         - type: lxml.etree
     """
-    original_air_date = re.search( r'(\d{2})[\/|\.|\-](\d{2})[\/|\.|\-](\d{4})', event['shortdesc'])
-    match_epnum, epnum, is_premiere = parseSEP(event['shortdesc'])
+    from lxml import etree
+    match_epnum = event_text.match_epnum
+    epnum = event_text.epnum
+    is_premiere = event_text.is_premiere
 
     # Don't attempt to put an episode-num to certain categories
     try:
@@ -284,34 +1860,26 @@ def addSeriesInfo2Programme(programme, event, air_dt):
         if is_premiere:
             _ = etree.SubElement(programme, 'premiere')
 
-    if original_air_date:
+    if event_text.original_air_date:
         programme_epnum = etree.SubElement(programme, 'episode-num')
         programme_epnum.attrib['system'] = 'original-air-date'
-        programme_epnum.text = "{}-{}-{}".format(
-            original_air_date.group(3),
-            original_air_date.group(2),
-            original_air_date.group(1))
-        try:
-            original_air_dt = datetime.strptime(programme_epnum.text, '%Y-%m-%d')
-            if air_dt.date() > original_air_dt.date():
-                _ = etree.SubElement(programme, 'previously-shown')
-        except ValueError as e:
-            pass
-            # The orinal air date cannot be parse and will therefore be ignored
-            
+        programme_epnum.text = event_text.original_air_date
+        if event_text.original_air_dt and air_dt.date() > event_text.original_air_dt:
+            _ = etree.SubElement(programme, 'previously-shown')
+
     return programme
 
 
-def addMovieCredits(programme, event):
+def addMovieCredits(programme, event_text):
+    from lxml import etree
     try:
         existing_category = programme.find('category')
         if existing_category.text in ('Movie'):
-            cast = event['longdesc'].split('\n', 2)
-            if len(cast)>2:
+            if event_text.credits:
                 credits = etree.SubElement(programme, 'credits')
                 director = etree.SubElement(credits, 'director')
-                director.text = cast[1]
-                for cast in cast[2][:-1].split('\n'):
+                director.text = event_text.credits[0]
+                for cast in event_text.credits[1]:
                     actor = etree.SubElement(credits, 'actor')
                     actor.text = cast
     except AttributeError:
@@ -319,7 +1887,75 @@ def addMovieCredits(programme, event):
     return programme
 
 
+class CategoryOverrides(object):
+    """
+    Category overrides compiled into an Aho-Corasick automaton so the title of
+    a programme is matched against all the title patterns in a single pass.
+
+    The matching is the same as checking `pattern in title.upper()` for each
+    of the upper case patterns: the categories of all the matching patterns
+    are returned in the order of the patterns.
+    """
+    def __init__(self, overrides):
+        self.overrides = overrides
+        self.patterns = list(overrides.keys())
+        # Trie of the patterns: transitions, failure links and the indexes of
+        # the patterns that end in each state.
+        self.transitions = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                if char not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.transitions[state][char] = len(self.transitions) - 1
+                state = self.transitions[state][char]
+            self.output[state].append(index)
+
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.transitions[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.transitions[fail_state].get(char, 0)
+                self.output[next_state] = (
+                    self.output[next_state] + self.output[self.fail[next_state]])
+
+    def __len__(self):
+        return len(self.overrides)
+
+    def items(self):
+        return self.overrides.items()
+
+    def match(self, title):
+        """
+        Returns the override categories for a title.
+        """
+        transitions = self.transitions
+        fail = self.fail
+        output = self.output
+        matches = set(output[0])
+        state = 0
+        for char in title.upper():
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            if output[state]:
+                matches.update(output[state])
+        categories = []
+        for index in sorted(matches):
+            categories.extend(self.overrides[self.patterns[index]])
+        return categories
+
+
 def load_overrides(category_override):
+    import yaml
     transformed_overrides = None
     if category_override:
         transformed_overrides = {}
@@ -334,10 +1970,59 @@ def load_overrides(category_override):
                             transformed_overrides[title.upper()] = [cat]
             except yaml.YAMLError:
                 raise
+        transformed_overrides = CategoryOverrides(transformed_overrides)
     return transformed_overrides
 
 
-def addEvents2XML(xmltv, epg, tzoffset, category_override):
+def addServiceEvents2XML(xmltv, service_program, events, overrides):
+    """
+    Function to add the events (programms) of a single service to the XMLTV
+    structure.
+
+    returns:
+        - type: lxml.etree
+    """
+    from lxml import etree
+    for event in events:
+        # Time Calculations and transformations
+        start_dt_str = formatXMLTVTime(event['begin_timestamp'])
+        end_dt_str = formatXMLTVTime(event['begin_timestamp'] + event['duration'] * 60)
+
+        programme = etree.SubElement(xmltv, 'programme')
+        programme.attrib['channel'] = str(service_program)
+        programme.attrib['start'] = start_dt_str
+        programme.attrib['stop'] = end_dt_str
+
+        programme_duration = etree.SubElement(programme, 'length')
+        programme_duration.attrib['units'] = 'minutes'
+        programme_duration.text = str(event['duration'])
+
+        event_text = parseEventText(event['title'], event['shortdesc'], event['longdesc'])
+
+        # Get the Description of the program - Assumes English language
+        programme_desc = etree.SubElement(programme, 'desc')
+        programme_desc.text = event_text.desc
+        if event_text.subtitle is not None:
+            programme_subtitle = etree.SubElement(programme, 'sub-title')
+            programme_subtitle.text = event_text.subtitle
+            programme_subtitle.attrib['lang'] = 'en'
+        programme_desc.attrib['lang'] = 'en'
+
+        programme_title = etree.SubElement(programme, 'title')
+        programme_title.text = event_text.title
+        programme_title.attrib['lang'] = 'en'
+
+        programme = addCategories2Programme(event['title'], programme, event_text, overrides)
+        start_dt = None
+        if event_text.original_air_dt:
+            start_dt = datetime.fromtimestamp(event['begin_timestamp'])
+        programme = addSeriesInfo2Programme(programme, event_text, start_dt)
+        programme = addMovieCredits(programme, event_text)
+
+    return xmltv
+
+
+def addEvents2XML(xmltv, epg, category_override):
     """
     Function to add events (programms) to the XMLTV structure.
 
@@ -347,56 +2032,224 @@ def addEvents2XML(xmltv, epg, tzoffset, category_override):
     overrides = load_overrides(category_override)
 
     for service_program, events in epg.items():
-        for event in events:
-            # Time Calculations and transformations
-            start_dt = datetime.fromtimestamp(event['begin_timestamp'])
-            start_dt_str = start_dt.strftime("%Y%m%d%H%M%S {}".format(tzoffset))
-            end_dt = start_dt + timedelta(minutes=event['duration'])
-            end_dt_str = end_dt.strftime("%Y%m%d%H%M%S {}".format(tzoffset))
-
-            programme = etree.SubElement(xmltv, 'programme')
-            programme.attrib['channel'] = str(service_program)
-            programme.attrib['start'] = start_dt_str
-            programme.attrib['stop'] = end_dt_str
-
-            programme_duration = etree.SubElement(programme, 'length')
-            programme_duration.attrib['units'] = 'minutes'
-            programme_duration.text = str(event['duration'])
-
-            # Get the Description of the program - Assumes English language
-            programme_desc = etree.SubElement(programme, 'desc')
-            if event['longdesc'] == '':
-                programme_desc.text = unescape(event['shortdesc'])
-            else:
-                programme_desc.text = unescape(event['longdesc'])
-                subtitle_first_step = re.sub(r'^(\[.+\]\s*)', '', event['shortdesc'])
-                subtitle = re.sub(r'\s*\([SE]\d+.*\)', '', subtitle_first_step)
-                if len(subtitle) > 0:
-                    programme_subtitle = etree.SubElement(programme, 'sub-title')
-                    programme_subtitle.text = unescape(subtitle)
-                    programme_subtitle.attrib['lang'] = 'en'
-            programme_desc.attrib['lang'] = 'en'
-            if event['shortdesc'] == '':
-                event['shortdesc'] = event['longdesc']
-
-            # Get the title and remove the word NEW if present 
-            title = unescape(event['title'])
-            if 'New: ' in title:
-                #_ = etree.SubElement(programme, 'premiere')
-                title = title.replace('New: ', '')
-            programme_title = etree.SubElement(programme, 'title')
-            programme_title.text = title 
-            programme_title.attrib['lang'] = 'en'
-
-            programme = addCategories2Programme(event['title'], programme, event, overrides)
-            programme = addSeriesInfo2Programme(programme, event, start_dt)   
-            programme = addMovieCredits(programme, event)         
+        xmltv = addServiceEvents2XML(xmltv, service_program, events, overrides)
+    logEventTextCacheInfo()
 
     return xmltv
 
 
-def generateXMLTV(bouquets_services, epg, api_root_url, tzoffset,
-        continuous_numbering, category_override):
+def createXMLTVRoot():
+    """
+    Function to create the root element of the XMLTV object.
+
+    returns:
+        - type: lxml.etree
+    """
+    from lxml import etree
+    xmltv = etree.Element('tv')
+    xmltv.attrib['generator-info-url'] = 'https://github.com/cvarelaruiz'
+    xmltv.attrib['generator-info-name'] = 'OpenWebIf 2 Plex XMLTV'
+    xmltv.attrib['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return xmltv
+
+
+def serialiseXMLTVFragment(wrapper):
+    """
+    Function to serialise the children of a throwaway root element exactly as
+    they would be if they were part of the full XMLTV tree. lxml indents the
+    pretty printed output relative to the serialised element, so they are
+    serialised within the wrapper and the wrapper's tags are removed.
+
+    returns:
+        - type: string
+    """
+    from lxml import etree
+    fragment = etree.tostring(wrapper, encoding='unicode', pretty_print=True)
+    return fragment[len('<tv>\n'):-len('</tv>\n')]
+
+
+def renderConfigDigest(overrides):
+    """
+    Function to get a digest of everything but the events that changes how
+    the fragments are rendered: the category overrides, the time zone and
+    the code of owi2plex itself.
+    """
+    config = hashlib.sha1()
+    with open(os.path.realpath(__file__), 'rb') as f:
+        config.update(f.read())
+    config.update(json.dumps([
+        sorted(overrides.items()) if overrides else None,
+        os.environ.get('TZ'), list(time.tzname), time.timezone, time.altzone,
+    ], default=str).encode('utf-8'))
+    return config.hexdigest()
+
+
+def fragmentDigest(config_digest, *args):
+    """
+    Function to get the digest a rendered fragment is cached with, from the
+    config digest (see renderConfigDigest) and what the fragment is rendered
+    from, which must have a stable repr.
+    """
+    return hashlib.sha1(repr((config_digest, args)).encode('utf-8')).hexdigest()
+
+
+def eventsFields(events):
+    """
+    Function to get the fields of the events as a list of tuples, to get
+    the digest of the programmes of a service.
+    """
+    return [EVENT_FIELDS(event) if event.__class__ is Event else sorted(event.items())
+        for event in events]
+
+
+def renderServiceEvents(service_program, events, overrides):
+    """
+    Function to render the programmes of a service as a serialised fragment
+    of the XMLTV object.
+
+    returns:
+        - type: string
+    """
+    from lxml import etree
+    wrapper = etree.Element('tv')
+    addServiceEvents2XML(wrapper, service_program, events, overrides)
+    return serialiseXMLTVFragment(wrapper)
+
+
+def initRenderWorker(overrides):
+    global render_overrides
+    render_overrides = overrides
+
+
+def renderServiceEventsWorker(service_program, events):
+    return renderServiceEvents(service_program, events, render_overrides)
+
+
+def iterRenderedProgrammes(epg, overrides, jobs=1, fragment_cache=None,
+        config_digest=''):
+    """
+    Function to render the programmes of every service in the epg, in order.
+    With more than one job the services are rendered by a pool of jobs
+    processes, keeping a bounded number of them queued so the fragments are
+    written as they come in.
+
+    With a fragment cache only the services whose events have changed are
+    rendered, the rest are taken from the cache.
+
+    returns:
+        - type: generator of strings
+    """
+    def cached(service_program, events):
+        if not fragment_cache:
+            return None, None
+        digest = fragmentDigest(config_digest, 'programmes', service_program,
+            eventsFields(events))
+        return digest, fragment_cache.get(digest)
+
+    if jobs <= 1:
+        for service_program, events in epg.items():
+            if events:
+                digest, fragment = cached(service_program, events)
+                if fragment is None:
+                    fragment = renderServiceEvents(service_program, events, overrides)
+                    if digest:
+                        fragment_cache.put(digest, fragment)
+                yield fragment
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=initRenderWorker,
+            initargs=(overrides,)) as executor:
+        pending = collections.deque()
+
+        def result():
+            digest, render = pending.popleft()
+            fragment = render.result()
+            if digest:
+                fragment_cache.put(digest, fragment)
+            return fragment
+
+        for service_program, events in epg.items():
+            if events:
+                digest, fragment = cached(service_program, events)
+                if fragment is None:
+                    pending.append((digest, executor.submit(
+                        renderServiceEventsWorker, service_program, events)))
+                else:
+                    render = Future()
+                    render.set_result(fragment)
+                    pending.append((None, render))
+                if len(pending) >= jobs * 4:
+                    yield result()
+        while pending:
+            yield result()
+
+
+def iterXMLTV(bouquets_services, epg, api_root_url, continuous_numbering,
+        category_override, jobs=1, fragment_cache=None):
+    """
+    Function to generate the XMLTV object incrementally. Each channel and the
+    programmes of each service are built in their own throwaway element and
+    serialised, so only one of them is in memory at any time. The programmes
+    can be rendered by several processes (see iterRenderedProgrammes). With
+    a fragment cache the channels and programmes rendered from the same data
+    in a previous run are reused.
+
+    returns:
+        - type: generator of strings
+        - desc: Consecutive pieces of the XMLTV object as a String.
+    """
+    from lxml import etree
+    root = etree.tostring(createXMLTVRoot(), encoding='unicode')
+    overrides = load_overrides(category_override)
+    config_digest = renderConfigDigest(overrides) if fragment_cache else ''
+
+    def fragments():
+        try:
+            for fragment in renderFragments():
+                yield fragment
+        finally:
+            # Also when the XMLTV is abandoned, to end the transaction of the
+            # fragments written so far
+            if fragment_cache:
+                fragment_cache.flush()
+                logger.info(fragment_cache.summary())
+
+    def renderFragments():
+        for service, position in iterChannelPositions(bouquets_services, continuous_numbering):
+            digest = fragment = None
+            if fragment_cache:
+                events = epg.get(service['program'])
+                digest = fragmentDigest(config_digest, 'channel', api_root_url,
+                    sorted(service.items()), position, bool(events),
+                    channelPicon(events or []))
+                fragment = fragment_cache.get(digest)
+            if fragment is None:
+                wrapper = etree.Element('tv')
+                addChannel2XML(wrapper, service, position, epg, api_root_url)
+                fragment = serialiseXMLTVFragment(wrapper)
+                if digest:
+                    fragment_cache.put(digest, fragment)
+            yield fragment
+        for fragment in iterRenderedProgrammes(epg, overrides, jobs,
+                fragment_cache, config_digest):
+            yield fragment
+        logEventTextCacheInfo()
+
+    is_empty = True
+    for fragment in fragments():
+        if is_empty:
+            # Turn the empty element <tv .../> into the opening tag <tv ...>
+            yield root[:-len('/>')] + '>\n'
+            is_empty = False
+        yield fragment
+    if is_empty:
+        yield root + '\n'
+    else:
+        yield '</tv>\n'
+
+
+def generateXMLTV(bouquets_services, epg, api_root_url, continuous_numbering,
+        category_override, jobs=1, fragment_cache=None):
     """
     Function to generate the XMLTV object
 
@@ -406,15 +2259,834 @@ def generateXMLTV(bouquets_services, epg, api_root_url, tzoffset,
     """
     global logger
     logger.info(u"Generating XMLTV payload.")
-    xmltv = etree.Element('tv')
-    xmltv.attrib['generator-info-url'] = 'https://github.com/cvarelaruiz'
-    xmltv.attrib['generator-info-name'] = 'OpenWebIf 2 Plex XMLTV'
-    xmltv.attrib['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return u''.join(iterXMLTV(bouquets_services, epg, api_root_url,
+        continuous_numbering, category_override, jobs, fragment_cache))
+
+
+def openCompressed(raw_file, output_file):
+    """
+    Function to wrap the raw file with a streaming compressor when the output
+    file ends in .gz or .xz.
+    """
+    if output_file.endswith('.gz'):
+        return gzip.GzipFile(filename='', mode='wb', fileobj=raw_file, mtime=0)
+    if output_file.endswith('.xz'):
+        return lzma.LZMAFile(raw_file, mode='wb')
+    return None
+
+
+def writeXMLTV(output_file, bouquets_services, epg, api_root_url,
+        continuous_numbering, category_override, jobs=1, metrics=None,
+        fragment_cache=None):
+    """
+    Function to write the XMLTV object to the output file as it's generated,
+    UTF-8 encoded with a BOM and compressed when the output file ends in .gz
+    or .xz.
+
+    It's written to a temporary file next to the output file that replaces it
+    once complete, so a reader never sees a partial file. When the content is
+    the same as the one previously written, apart from the generation date,
+    the output file is left untouched.
+
+    The time spent generating and writing the XMLTV is added to the render
+    and write phases of metrics, along with the hits and misses of the
+    fragment cache (see iterXMLTV).
+
+    returns:
+        - type: bool
+        - desc: Whether the output file has been replaced.
+    """
+    global logger
+    metrics = metrics or RunMetrics()
+    logger.info(u"Saving XMLTV payload to file {}".format(output_file))
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    hash_file = os.path.join(output_dir, '.{}.sha256'.format(os.path.basename(output_file)))
+    if os.path.exists(output_file):
+        mode = os.stat(output_file).st_mode & 0o777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+
+    content_hash = hashlib.sha256()
+    raw_file = tempfile.NamedTemporaryFile(dir=output_dir, delete=False,
+        prefix='.{}.'.format(os.path.basename(output_file)), suffix='.tmp')
+    try:
+        with raw_file:
+            xmltv_file = openCompressed(raw_file, output_file) or raw_file
+            xmltv_file.write(codecs.BOM_UTF8)
+            fragments = iterXMLTV(bouquets_services, epg, api_root_url,
+                continuous_numbering, category_override, jobs, fragment_cache)
+            if fragment_cache:
+                cache_stats = fragment_cache.stats.copy()
+            is_root = True
+            while True:
+                with metrics.phase('render'):
+                    fragment = next(fragments, None)
+                if fragment is None:
+                    break
+                with metrics.phase('write'):
+                    fragment = fragment.encode('utf-8')
+                    xmltv_file.write(fragment)
+                    # The root element has the generation date
+                    if not is_root:
+                        content_hash.update(fragment)
+                    is_root = False
+            if fragment_cache:
+                for stat in ('hits', 'misses'):
+                    metrics.count('render_cache_' + stat,
+                        fragment_cache.stats[stat] - cache_stats[stat])
+            with metrics.phase('write'):
+                if xmltv_file is not raw_file:
+                    xmltv_file.close()
+                raw_file.flush()
+                os.fsync(raw_file.fileno())
+
+        content_hash = content_hash.hexdigest()
+        previous_hash = None
+        if os.path.exists(output_file) and os.path.exists(hash_file):
+            with open(hash_file, 'r') as f:
+                previous_hash = f.read().strip()
+        if content_hash == previous_hash:
+            logger.info(u"The XMLTV hasn't changed, keeping {}".format(output_file))
+            os.remove(raw_file.name)
+            return False
+
+        os.chmod(raw_file.name, mode)
+        os.replace(raw_file.name, output_file)
+    except BaseException:
+        if os.path.exists(raw_file.name):
+            os.remove(raw_file.name)
+        raise
+
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(output_dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    with open(hash_file, 'w') as f:
+        f.write(content_hash)
+    return True
+
+
+Target = collections.namedtuple('Target', [
+    'output_file', 'format', 'bouquets', 'continuous_numbering', 'category_override'])
+
+TARGET_FORMATS = ('xmltv', 'jsonl', 'sqlite')
+
+
+def loadTargets(targets_file, continuous_numbering=False, category_override=None):
+    """
+    Function to load the outputs written from a single fetch of the EPG from
+    a YAML file like:
+
+        targets:
+          - output: /tmp/{bouquet}.xml
+            bouquets: [TV, Sports]
+          - output: /tmp/epg.xml.gz
+            continuous_numbering: true
+          - output: /tmp/epg.jsonl
+            category_override: false
+
+    The format of each target is taken from the extension of its output
+    (.jsonl or .sqlite/.db) unless given with format. A target has the
+    channels of all the bouquets unless given some, and one output per
+    bouquet when the output has a {bouquet} placeholder. The numbering and
+    category override default to the ones of the command line, and false
+    disables the overrides of a target.
+
+    returns:
+        - type: list of Target
+    """
+    import yaml
+    with open(targets_file, 'r', encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    specs = config.get('targets') if isinstance(config, dict) else config
+    if not isinstance(specs, list) or not specs:
+        raise ValueError(u"{} has no list of targets".format(targets_file))
+    targets = []
+    for spec in specs:
+        if not isinstance(spec, dict) or not spec.get('output'):
+            raise ValueError(u"Target without output: {}".format(spec))
+        output_file = str(spec['output'])
+        target_format = spec.get('format')
+        if not target_format:
+            target_format = 'xmltv'
+            if output_file.endswith('.jsonl'):
+                target_format = 'jsonl'
+            elif output_file.endswith(('.sqlite', '.db')):
+                target_format = 'sqlite'
+        if target_format not in TARGET_FORMATS:
+            raise ValueError(u"Unknown format {} of target {}".format(
+                target_format, output_file))
+        bouquets = spec.get('bouquets')
+        if isinstance(bouquets, str):
+            bouquets = [bouquets]
+        target_override = spec.get('category_override', category_override)
+        targets.append(Target(output_file, target_format,
+            tuple(bouquets) if bouquets else None,
+            bool(spec.get('continuous_numbering', continuous_numbering)),
+            target_override or None))
+    return targets
+
+
+def targetsBouquets(targets):
+    """
+    Function to get the names of the bouquets the targets need, or None if
+    some of them need all the bouquets.
+    """
+    if any(not target.bouquets for target in targets):
+        return None
+    names = []
+    for target in targets:
+        names.extend(name for name in target.bouquets if name not in names)
+    return names
+
+
+def expandTargets(targets, bouquets_services):
+    """
+    Function to expand the targets with a {bouquet} placeholder in their
+    output into one target per bouquet.
+
+    returns:
+        - type: generator of Target
+    """
+    for target in targets:
+        if '{bouquet}' not in target.output_file:
+            yield target
+            continue
+        for name in target.bouquets or bouquets_services.keys():
+            file_name = re.sub(r'[^\w.-]+', '_', name).strip('_') or 'bouquet'
+            yield target._replace(output_file=target.output_file.replace(
+                '{bouquet}', file_name), bouquets=(name,))
+
+
+def selectBouquets(bouquets_services, epg, names=None):
+    """
+    Function to get the bouquets named and the EPG of their services, or all
+    of them if no names are given.
 
-    xmltv = addChannels2XML(xmltv, bouquets_services, epg, api_root_url, continuous_numbering)
-    xmltv = addEvents2XML(xmltv, epg, tzoffset, category_override)
+    returns:
+        - type: tuple
+        - model: (bouquets_services, epg)
+    """
+    global logger
+    if not names:
+        return bouquets_services, epg
+    selected = collections.OrderedDict()
+    for name in names:
+        if name in bouquets_services:
+            selected[name] = bouquets_services[name]
+        else:
+            logger.warning(u"Bouquet {} not found".format(name))
+    programs = set(service['program'] for services in selected.values()
+        for service in services if service['pos'])
+    return selected, collections.OrderedDict(
+        (program, events) for program, events in epg.items() if program in programs)
 
-    return etree.tostring(xmltv, encoding='unicode', pretty_print=True)
+
+def iterNormalisedChannels(bouquets_services, epg, api_root_url,
+        continuous_numbering, overrides):
+    """
+    Function to iterate the channels and their events as plain dicts, with
+    the texts of the events parsed and cleaned as they're written to the
+    XMLTV, for the JSON Lines and SQLite targets. Channels in several
+    bouquets are only iterated once.
+
+    returns:
+        - type: generator of (channel_dict, [event_dict_1, ...]) tuples
+    """
+    seen = set()
+    for service, position in iterChannelPositions(bouquets_services, continuous_numbering):
+        program = service['program']
+        if program in seen:
+            continue
+        seen.add(program)
+        events = epg.get(program) or []
+        picon = channelPicon(events)
+        if picon and not picon.startswith(('http://', 'https://')):
+            picon = '{}{}'.format(api_root_url, picon)
+        channel = {
+            'id': program,
+            'sref': service['servicereference'],
+            'name': unescape(service['servicename']),
+            'number': position,
+            'picon': picon,
+        }
+        normalised = []
+        for event in events:
+            event_text = parseEventText(event['title'], event['shortdesc'], event['longdesc'])
+            normalised.append({
+                'id': event['id'],
+                'start': event['begin_timestamp'],
+                'stop': event['begin_timestamp'] + event['duration'] * 60,
+                'duration': event['duration'],
+                'title': event_text.title,
+                'subtitle': event_text.subtitle,
+                'desc': event_text.desc,
+                'categories': programmeCategories(event['title'], event_text, overrides),
+                'episode': event_text.epnum if event_text.match_epnum else None,
+                'premiere': event_text.is_premiere,
+                'original_air_date': event_text.original_air_date,
+            })
+        yield channel, normalised
+
+
+def writeJSONLines(output_file, channels):
+    """
+    Function to write the normalised events (see iterNormalisedChannels) to
+    a JSON Lines file, one event per line along with its channel.
+    """
+    with openAtomically(output_file) as f:
+        for channel, events in channels:
+            for event in events:
+                record = {'channel': channel['id'], 'channel_name': channel['name'],
+                    'channel_number': channel['number']}
+                record.update(event)
+                f.write(json.dumps(record, ensure_ascii=False))
+                f.write('\n')
+
+
+def writeSQLite(output_file, channels):
+    """
+    Function to write the normalised channels and events (see
+    iterNormalisedChannels) to a new SQLite database with the tables channels
+    and events.
+    """
+    import sqlite3
+    with openAtomically(output_file, 'wb') as f:
+        db = sqlite3.connect(f.name)
+        try:
+            with db:
+                db.execute('CREATE TABLE channels (id INTEGER PRIMARY KEY, sref TEXT, '
+                    'name TEXT, number INTEGER, picon TEXT)')
+                db.execute('CREATE TABLE events (channel INTEGER, id INTEGER, '
+                    'start INTEGER, stop INTEGER, duration INTEGER, title TEXT, '
+                    'subtitle TEXT, desc TEXT, categories TEXT, episode TEXT, '
+                    'premiere INTEGER, original_air_date TEXT)')
+                db.execute('CREATE INDEX events_channel_start ON events (channel, start)')
+                for channel, events in channels:
+                    db.execute('INSERT INTO channels VALUES (?, ?, ?, ?, ?)', (
+                        channel['id'], channel['sref'], channel['name'],
+                        channel['number'], channel['picon']))
+                    db.executemany('INSERT INTO events VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', ((
+                            channel['id'], e['id'], e['start'], e['stop'],
+                            e['duration'], e['title'], e['subtitle'], e['desc'],
+                            json.dumps(e['categories'], ensure_ascii=False),
+                            e['episode'], e['premiere'], e['original_air_date'])
+                        for e in events))
+        finally:
+            db.close()
+
+
+def writeTargets(targets, bouquets_services, epg, api_root_url, jobs=1,
+        metrics=None, fragment_cache=None):
+    """
+    Function to write every target (see loadTargets) from the same EPG. The
+    XMLTV targets share the fragment cache, so the channels of a bouquet
+    rendered for one of them are reused by the others with the same
+    overrides.
+
+    returns:
+        - type: list
+        - desc: Output files written.
+    """
+    global logger
+    metrics = metrics or RunMetrics()
+    written = []
+    for target in expandTargets(targets, bouquets_services):
+        services, target_epg = selectBouquets(bouquets_services, epg, target.bouquets)
+        logger.info(u"Writing {} target {} with {} bouquet(s)".format(
+            target.format, target.output_file, len(services)))
+        if target.format == 'xmltv':
+            writeXMLTV(target.output_file, services, target_epg, api_root_url,
+                target.continuous_numbering, target.category_override, jobs,
+                metrics, fragment_cache)
+        else:
+            channels = iterNormalisedChannels(services, target_epg, api_root_url,
+                target.continuous_numbering, load_overrides(target.category_override))
+            with metrics.phase('export'):
+                if target.format == 'jsonl':
+                    writeJSONLines(target.output_file, channels)
+                else:
+                    writeSQLite(target.output_file, channels)
+        written.append(target.output_file)
+    metrics.count('targets', len(written))
+    return written
+
+
+def retrieveEPG(bouquet, api_root_url, list_bouquets=False, max_workers=1,
+        fetch_mode='service', cache=None, metrics=None, window=None,
+        governor=None):
+    """
+    Function to retrieve the bouquets, their services and the EPG of the
+    services in the time window from the OpenWebif API, timing each step in
+    metrics. The EPG requests go through the governor when given.
+
+    returns:
+        - type: tuple
+        - model: (bouquets_services, epg, failures) as returned by
+          getBouquetsServices and getEPGs
+    """
+    global logger
+    metrics = metrics or RunMetrics()
+    if cache:
+        logger.info(u"Expired {} past events from the cache".format(cache.expire()))
+        cache_stats = cache.stats.copy()
+    with metrics.phase('bouquets'):
+        bouquets = getBouquets(bouquet=bouquet, api_root_url=api_root_url,
+            list_bouquets=list_bouquets)
+    with metrics.phase('services'):
+        bouquets_services = getBouquetsServices(bouquets=bouquets,
+            api_root_url=api_root_url, cache=cache)
+    failures = {}
+    with metrics.phase('epg'):
+        epg = getEPGs(bouquets_services=bouquets_services, api_root_url=api_root_url,
+            max_workers=max_workers, failures=failures, fetch_mode=fetch_mode,
+            bouquets=bouquets, cache=cache, window=window, governor=governor)
+    if governor:
+        logger.info(governor.summary())
+        metrics.gauge('concurrency', round(governor.settled, 1))
+    metrics.count('bouquets', len(bouquets))
+    metrics.count('channels', sum(1 for _, services in bouquets_services.items()
+        for service in services if service['pos']))
+    metrics.count('events', sum(len(events) for events in epg.values()))
+    metrics.count('failed_services', len(failures))
+    if cache:
+        for stat in ('epg_hits', 'epg_misses'):
+            metrics.count('cache_' + stat, cache.stats[stat] - cache_stats[stat])
+        logger.info(cache.summary())
+    if failures:
+        logger.warning(u"EPG couldn't be retrieved for {} service(s): {}".format(
+            len(failures), u", ".join(str(p) for p in failures)))
+    return bouquets_services, epg, failures
+
+
+def mergeBouquetsServices(receivers_services):
+    """
+    Function to merge the services of the bouquets of several receivers into
+    the channels of a single XMLTV. Services already in the bouquets of a
+    previous receiver are left out, along with the bouquets left without
+    services, and bouquets with the same name in several receivers get the
+    name of the receiver appended.
+
+    params:
+        - receivers_services: {"receiver_name": bouquets_services}
+    returns:
+        - type: dict
+        - model: bouquets_services as returned by getBouquetsServices
+    """
+    merged = collections.OrderedDict()
+    seen = set()
+    for receiver_name, bouquets_services in receivers_services.items():
+        receiver_seen = set()
+        for bouquet_name, services in bouquets_services.items():
+            services = [service for service in services
+                if serviceRefKey(service['servicereference']) not in seen]
+            receiver_seen.update(serviceRefKey(service['servicereference'])
+                for service in services if service['pos'])
+            if not any(service['pos'] for service in services):
+                continue
+            if bouquet_name in merged:
+                bouquet_name = u"{} ({})".format(bouquet_name, receiver_name)
+            merged[bouquet_name] = services
+        seen.update(receiver_seen)
+    return merged
+
+
+def planReceiversFetch(receivers_services):
+    """
+    Function to spread the EPG requests across the receivers. Every service
+    is requested from only one of the receivers that carry it, the one with
+    the fewest services assigned so far, starting with the services carried
+    by a single receiver.
+
+    params:
+        - receivers_services: {"receiver_name": bouquets_services}
+    returns:
+        - type: tuple
+        - model:
+            (
+                {"receiver_name": bouquets_services with the assigned services},
+                {"sRef_key": ["receiver_name_1", "receiver_name_2", ...]}
+            )
+    """
+    carriers = collections.OrderedDict()
+    for receiver_name, bouquets_services in receivers_services.items():
+        for services in bouquets_services.values():
+            for service in services:
+                if service['pos']:
+                    names = carriers.setdefault(serviceRefKey(service['servicereference']), [])
+                    if receiver_name not in names:
+                        names.append(receiver_name)
+    load = collections.Counter()
+    assigned = {}
+    for key, names in sorted(carriers.items(), key=lambda item: len(item[1])):
+        assigned[key] = min(names, key=lambda name: load[name])
+        load[assigned[key]] += 1
+
+    plan = collections.OrderedDict()
+    for receiver_name, bouquets_services in receivers_services.items():
+        plan[receiver_name] = collections.OrderedDict(
+            (bouquet_name, [service for service in services if service['pos']
+                and assigned[serviceRefKey(service['servicereference'])] == receiver_name])
+            for bouquet_name, services in bouquets_services.items())
+    return plan, carriers
+
+
+def channelHorizon(events):
+    """
+    Function to get the time the last event of a channel ends.
+    """
+    return max((event['begin_timestamp'] + event['duration'] * 60 for event in events),
+        default=0)
+
+
+def pickChannelEvents(candidates):
+    """
+    Function to pick the most complete of the events of a channel retrieved
+    from several receivers: the ones reaching furthest into the future, or
+    the most of them if they reach as far.
+
+    params:
+        - candidates: [("receiver_name", events), ...]
+    returns:
+        - type: tuple
+        - model: ("receiver_name", events)
+    """
+    return max(candidates, key=lambda candidate: (
+        channelHorizon(candidate[1]), len(candidate[1])))
+
+
+def retrieveFederatedEPG(receivers, list_bouquets=False, max_workers=1,
+        fetch_mode='service', caches=None, metrics=None, window=None,
+        governors=None):
+    """
+    Function to retrieve the EPG of several receivers in parallel and merge
+    it by service reference into the channels of a single XMLTV, timing
+    each step in metrics.
+
+    Each service carried by several receivers is only requested from one of
+    them (see planReceiversFetch). When that receiver has no events for it
+    the rest of the receivers that carry it are asked, and the most complete
+    events are kept (see pickChannelEvents). Picons point to the receiver
+    the events come from.
+
+    params:
+        - receivers: [Receiver_1, Receiver_2, ...]
+        - caches: {"receiver_name": EPGCache}
+        - governors: {"receiver_name": ConcurrencyGovernor}
+    returns:
+        - type: tuple
+        - model: (bouquets_services, epg, failures) as returned by
+          retrieveEPG
+    """
+    global logger
+    caches = caches or {}
+    governors = governors or {}
+    metrics = metrics or RunMetrics()
+    receivers = collections.OrderedDict((r.name, r) for r in receivers)
+    cache_stats = collections.Counter()
+    for cache in caches.values():
+        logger.info(u"Expired {} past events from the cache".format(cache.expire()))
+        cache_stats.update(cache.stats)
+
+    # An executor per phase, so its threads are profiled with the phase
+    with metrics.phase('bouquets'), ThreadPoolExecutor(
+            max_workers=len(receivers)) as executor:
+        bouquets = collections.OrderedDict(zip(receivers, executor.map(
+            lambda r: getBouquets(r.bouquet, r.api_root_url, list_bouquets),
+            receivers.values())))
+    with metrics.phase('services'), ThreadPoolExecutor(
+            max_workers=len(receivers)) as executor:
+        receivers_services = collections.OrderedDict(zip(receivers, executor.map(
+            lambda r: getBouquetsServices(bouquets[r.name], r.api_root_url,
+                cache=caches.get(r.name)), receivers.values())))
+    bouquets_services = mergeBouquetsServices(receivers_services)
+    plan, carriers = planReceiversFetch(receivers_services)
+    logger.info(u"Planned EPG for {} services across {} receivers: {}".format(
+        len(carriers), len(receivers), u", ".join(u"{} {}".format(name,
+            sum(len(services) for services in plan[name].values()))
+            for name in receivers)))
+
+    failures = dict((name, {}) for name in receivers)
+
+    def fetch(receiver_name, receiver_services, receiver_fetch_mode):
+        return getEPGs(receiver_services, receivers[receiver_name].api_root_url,
+            max_workers=max_workers, failures=failures[receiver_name],
+            fetch_mode=receiver_fetch_mode, bouquets=bouquets[receiver_name],
+            cache=caches.get(receiver_name), window=window,
+            governor=governors.get(receiver_name))
+
+    with metrics.phase('epg'), ThreadPoolExecutor(
+            max_workers=len(receivers)) as executor:
+        fetched = collections.OrderedDict(zip(receivers, executor.map(
+            lambda name: fetch(name, plan[name], fetch_mode), receivers)))
+        # The services without events are asked to the rest of receivers
+        retries = collections.OrderedDict((name, collections.OrderedDict())
+            for name in receivers)
+        for receiver_name, receiver_services in plan.items():
+            for bouquet_name, services in receiver_services.items():
+                for service in services:
+                    if fetched[receiver_name].get(service['program']):
+                        continue
+                    for other in carriers[serviceRefKey(service['servicereference'])]:
+                        if other != receiver_name:
+                            retries[other].setdefault(bouquet_name, []).append(service)
+        retries = collections.OrderedDict((name, services)
+            for name, services in retries.items() if services)
+        if retries:
+            logger.info(u"Asking other receivers for the EPG of {} services".format(
+                len(set(service['program'] for services in retries.values()
+                    for bouquet in services.values() for service in bouquet))))
+        refetched = collections.OrderedDict(zip(retries, executor.map(
+            lambda name: fetch(name, retries[name], 'service'), retries)))
+
+    epg = collections.OrderedDict()
+    merged_failures = {}
+    for services in planEPGFetch(bouquets_services)[0].values():
+        for service in services:
+            candidates = []
+            for name in carriers[serviceRefKey(service['servicereference'])]:
+                for receiver_epg in (fetched[name], refetched.get(name, {})):
+                    if service['program'] in receiver_epg:
+                        candidates.append((name, receiver_epg[service['program']]))
+            receiver_name, events = pickChannelEvents(candidates)
+            picon = channelPicon(events)
+            if picon and not picon.startswith(('http://', 'https://')):
+                events = ChannelEvents(events, u'{}{}'.format(
+                    receivers[receiver_name].api_root_url, picon))
+            epg[service['program']] = events
+            if not events:
+                for name, _ in candidates:
+                    if service['program'] in failures[name]:
+                        merged_failures[service['program']] = failures[name][service['program']]
+
+    for name, governor in governors.items():
+        logger.info(u"{}: {}".format(name, governor.summary()))
+    if governors:
+        metrics.gauge('concurrency', round(sum(g.settled for g in governors.values()), 1))
+    metrics.count('receivers', len(receivers))
+    metrics.count('bouquets', sum(len(b) for b in bouquets.values()))
+    metrics.count('channels', sum(1 for _, services in bouquets_services.items()
+        for service in services if service['pos']))
+    metrics.count('events', sum(len(events) for events in epg.values()))
+    metrics.count('failed_services', len(merged_failures))
+    for cache in caches.values():
+        cache_stats.subtract(cache.stats)
+        logger.info(cache.summary())
+    if caches:
+        for stat in ('epg_hits', 'epg_misses'):
+            metrics.count('cache_' + stat, -cache_stats[stat])
+    if merged_failures:
+        logger.warning(u"EPG couldn't be retrieved for {} service(s): {}".format(
+            len(merged_failures), u", ".join(str(p) for p in merged_failures)))
+    return bouquets_services, epg, merged_failures
+
+
+FAILURE_POLICIES = ('empty', 'omit', 'reuse', 'abort')
+
+# Exit status of a run that couldn't retrieve the EPG of every service
+EXIT_INCOMPLETE = 3
+
+
+def resolveFailures(bouquets_services, epg, failures, on_failure='empty',
+        caches=(), window=None):
+    """
+    Function to deal with the services whose EPG couldn't be retrieved,
+    following the on_failure policy:
+        - empty: their channels are written without programmes
+        - omit: their channels are left out
+        - reuse: their channels get the last events retrieved for them that
+          haven't ended yet from the caches, or no programmes if there are
+          none
+        - abort: nothing is written
+    along with a summary of the services that failed.
+
+    returns:
+        - type: tuple
+        - model: (bouquets_services, epg, summary) where summary is None
+          when no service failed
+    """
+    global logger
+    if not failures:
+        return bouquets_services, epg, None
+    failed = collections.OrderedDict()
+    for services in bouquets_services.values():
+        for service in services:
+            if service['program'] in failures and service['pos']:
+                failed.setdefault(service['program'], service)
+    total = len(set(service['program'] for services in bouquets_services.values()
+        for service in services if service['pos']))
+
+    reused = 0
+    if on_failure == 'reuse':
+        epg = collections.OrderedDict(epg)
+        for program, service in failed.items():
+            for cache in caches:
+                events = cache.getLastEvents(service['servicereference'])
+                if events:
+                    epg[program] = filterEvents(events, window)
+                    reused += 1
+                    break
+    elif on_failure == 'omit':
+        bouquets_services = collections.OrderedDict((name, [service
+            for service in services if service['program'] not in failed])
+            for name, services in bouquets_services.items())
+        epg = collections.OrderedDict((program, events)
+            for program, events in epg.items() if program not in failed)
+
+    outcome = {
+        'empty': u"their channels have no programmes",
+        'omit': u"their channels have been left out",
+        'reuse': u"{} of their channels have their last good programmes".format(reused),
+        'abort': u"nothing has been written",
+    }[on_failure]
+    summary = u"EPG couldn't be retrieved for {} of {} services, {}:\n{}".format(
+        len(failed), total, outcome, u"\n".join(u"  {} ({}): {}".format(
+            unescape(service['servicename']), program, failures[program])
+            for program, service in failed.items()))
+    logger.warning(summary)
+    return bouquets_services, epg, summary
+
+
+def digestEPG(*args):
+    """
+    Function to get a digest of the data the XMLTV is generated from, to
+    tell whether it has changed since the last time.
+    """
+    return hashlib.sha1(json.dumps(args, default=str).encode('utf-8')).hexdigest()
+
+
+class XMLTVPublisher(object):
+    """
+    Latest XMLTV payload served in serve mode, along with its gzip compressed
+    version, ETag and modification time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.digest = None
+        self.payload = None
+
+    def publish(self, xmltv, digest):
+        """
+        Replaces the served XMLTV with the xmltv bytes generated from data
+        with the given digest.
+        """
+        etag = hashlib.sha1(xmltv).hexdigest()
+        # gzip.compress only takes an mtime from Python 3.8
+        compressed = io.BytesIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=compressed,
+                compresslevel=9, mtime=0) as gzip_file:
+            gzip_file.write(xmltv)
+        payload = {
+            'identity': (xmltv, '"{}"'.format(etag)),
+            'gzip': (compressed.getvalue(), '"{}-gzip"'.format(etag)),
+            'last_modified': int(datetime.now().timestamp()),
+        }
+        with self.lock:
+            self.payload = payload
+            self.digest = digest
+
+    def get(self):
+        with self.lock:
+            return self.payload
+
+
+def makeXMLTVRequestHandler(publisher, path='/epg.xml'):
+    """
+    Function to create the HTTP request handler serving the XMLTV of the
+    publisher at / and path. It answers conditional requests with a 304 and
+    sends the precompressed body to clients accepting gzip.
+    """
+    # Only serve mode needs them, they're kept out of the startup
+    from email.utils import formatdate, parsedate_to_datetime
+    from http.server import BaseHTTPRequestHandler
+
+    class XMLTVRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.sendXMLTV(with_body=True)
+
+        def do_HEAD(self):
+            self.sendXMLTV(with_body=False)
+
+        def isNotModified(self, etag, last_modified):
+            if_none_match = self.headers.get('If-None-Match')
+            if if_none_match:
+                etags = [e.strip() for e in if_none_match.split(',')]
+                return '*' in etags or etag in etags or 'W/' + etag in etags
+            if_modified_since = self.headers.get('If-Modified-Since')
+            if if_modified_since:
+                try:
+                    return parsedate_to_datetime(if_modified_since).timestamp() >= last_modified
+                except (TypeError, ValueError):
+                    pass
+            return False
+
+        def sendXMLTV(self, with_body):
+            if self.path.split('?')[0] not in ('/', path):
+                self.send_error(404)
+                return
+            payload = publisher.get()
+            if payload is None:
+                self.send_response(503)
+                self.send_header('Retry-After', '60')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            encoding = 'identity'
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                encoding = 'gzip'
+            body, etag = payload[encoding]
+            not_modified = self.isNotModified(etag, payload['last_modified'])
+            if not_modified:
+                self.send_response(304)
+            else:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                if encoding == 'gzip':
+                    self.send_header('Content-Encoding', 'gzip')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', formatdate(payload['last_modified'], usegmt=True))
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            if with_body and not not_modified:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            global logger
+            logger.info(u"{} - {}".format(self.address_string(), format % args))
+
+    return XMLTVRequestHandler
+
+
+def serveEPG(refresh, publisher, address, port, refresh_interval):
+    """
+    Function to serve the XMLTV of the publisher over HTTP while calling
+    refresh every refresh_interval seconds to keep it up to date.
+    """
+    global logger
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((address, port), makeXMLTVRequestHandler(publisher))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(u"Serving XMLTV on http://{}:{}/epg.xml".format(*server.server_address[:2]))
+    try:
+        while True:
+            try:
+                refresh()
+            except Exception:
+                logger.exception(u"Uh-oh! Unable to refresh the EPG ...")
+            sleep(refresh_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
 
 
 @click.command()
@@ -425,20 +3097,102 @@ def generateXMLTV(bouquets_services, epg, api_root_url, tzoffset,
 @click.option('-h', '--host', help='OpenWebIf host.', default='localhost',
     type=click.STRING)
 @click.option('-P', '--port', help='OpenWebIf port.', default=80, type=click.INT)
-@click.option('-o', '--output-file', help='Output file.', default='epg.xml',
-    type=click.STRING)
+@click.option('-R', '--receiver', help='Receiver to get the EPG from instead '
+              'of --host, as [username:password@]host[:port][/bouquet]. Give '
+              'it several times to merge the EPG of several receivers.',
+              multiple=True, type=click.STRING)
+@click.option('-o', '--output-file', help='Output file. Compressed when it '
+              'ends in .gz or .xz.', default='epg.xml', type=click.STRING)
+@click.option('--targets', help='YAML file of the outputs to write from the '
+              'same EPG instead of --output-file. See documentation for file '
+              'format.', type=click.STRING)
 @click.option('-c', '--continuous-numbering', help='Continuous numbering across'
               ' bouquets.', is_flag=True)
 @click.option('-l', '--list-bouquets', help='Display a list of bouquets.', 
     is_flag=True)
+@click.option('--list-services', help='Display a list of bouquets with their '
+              'services.', is_flag=True)
 @click.option('-V', '--version', help='Displays the version of the package.',
     is_flag=True)
 @click.option('-O', '--category-override', help='Category override YAML file. '
               'See documentation for file format.', type=click.STRING,)
 @click.option('-d', '--debug', help='Verbose Debugging.', is_flag=True)
+@click.option('-w', '--workers', help='Maximum number of EPG requests in '
+              'flight at the same time.', default=4, type=click.IntRange(min=1))
+@click.option('-a', '--adaptive', help='Adjust the number of EPG requests in '
+              'flight, up to --workers, to the latency and errors of the '
+              'receiver.', is_flag=True)
+@click.option('--max-rps', help='Maximum number of EPG requests per second to '
+              'each receiver.', type=click.FloatRange(min=0.01))
+@click.option('-t', '--timeout', help='Timeout in seconds of the requests to '
+              'OpenWebIf.', default=30, type=click.FloatRange(min=0))
+@click.option('-r', '--retries', help='Number of retries of the requests to '
+              'OpenWebIf on connection errors or server errors.', default=3,
+              type=click.IntRange(min=0))
+@click.option('-m', '--fetch-mode', help='Retrieve the EPG one request per '
+              'service or one request per bouquet.', default='service',
+              type=click.Choice(['service', 'bouquet']))
+@click.option('--cache-dir', help='Directory of the EPG cache.',
+              default=os.path.join(os.environ.get('XDG_CACHE_HOME',
+                  os.path.join(os.path.expanduser('~'), '.cache')), 'owi2plex'),
+              show_default=True, type=click.STRING)
+@click.option('--cache-ttl', help='Seconds after which the cached services and '
+              'EPGs are fetched again.', default=14400, show_default=True,
+              type=click.IntRange(min=0))
+@click.option('--no-cache', help='Fetch everything from OpenWebIf without '
+              'using the EPG cache.', is_flag=True)
+@click.option('--from', 'from_time', help='Only include the programmes from '
+              'this local date and time on. Defaults to now when --days is '
+              'given.', type=click.DateTime(formats=['%Y-%m-%d',
+                  '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M']))
+@click.option('--days', help='Only include the programmes of this many days.',
+              type=click.FloatRange(min=0))
+@click.option('--on-failure', help='What to do with the channels whose EPG '
+              "can't be retrieved: write them without programmes, omit them, "
+              'reuse their last good programmes from the EPG cache or write '
+              'nothing.', type=click.Choice(FAILURE_POLICIES), default='empty',
+              show_default=True)
+@click.option('--overlaps', help='What to do with the events that begin before '
+              'the previous one ends: keep them, trim the previous one or drop '
+              'them.', type=click.Choice(OVERLAP_POLICIES), default='keep',
+              show_default=True)
+@click.option('--fill-gaps', help='Fill the gaps of at least this many minutes '
+              'between events with an event titled "{}".'.format(GAP_TITLE),
+              type=click.IntRange(min=1))
+@click.option('-j', '--jobs', help='Number of processes rendering the '
+              'programmes.', default=1, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('-s', '--serve', help='Keep running, refreshing the EPG every '
+              '--refresh-interval seconds and serving the XMLTV over HTTP.',
+              is_flag=True)
+@click.option('--serve-address', help='Address the XMLTV is served on.',
+              default='127.0.0.1', show_default=True, type=click.STRING)
+@click.option('--serve-port', help='Port the XMLTV is served on.',
+              default=8080, show_default=True, type=click.INT)
+@click.option('--refresh-interval', help='Seconds between EPG refreshes in '
+              'serve mode.', default=3600, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--metrics-file', help='JSON file the timings and metrics of '
+              'the run are written to.', type=click.STRING)
+@click.option('--prometheus-file', help='Prometheus textfile collector file '
+              'the timings and metrics of the run are written to.',
+              type=click.STRING)
+@click.option('--profile', 'profile_dir', help='Directory the cProfile stats, '
+              'tracemalloc snapshots and a report of each phase of the run are '
+              'written to.', type=click.STRING)
 def main(bouquet=None, username=None, password=None, host='localhost', port=80,
     output_file='epg.xmltv', continuous_numbering=False, list_bouquets=False,
-    version=False, category_override=None, debug=False):
+    version=False, category_override=None, debug=False, workers=4, timeout=30,
+    retries=3, fetch_mode='service', cache_dir=None, cache_ttl=14400,
+    no_cache=False, jobs=1, serve=False, serve_address='127.0.0.1',
+    serve_port=8080, refresh_interval=3600, metrics_file=None,
+    prometheus_file=None, from_time=None, days=None, receiver=(),
+    list_services=False, adaptive=False, max_rps=None, targets=None,
+    profile_dir=None, overlaps='keep', fill_gaps=None, on_failure='empty'):
+
+    if version:
+        print(u"OWI2PLEX version {}".format(getVersion()))
+        exit(0)
 
     # Initialize Debugging
     if debug:
@@ -455,31 +3209,143 @@ def main(bouquet=None, username=None, password=None, host='localhost', port=80,
     global logger
     logger = logging.getLogger('OWI2PLEX')
 
-    if version:
-        print(u"OWI2PLEX version {}".format(__version__))
-        exit(0)
-
-    api_root_url = getAPIRoot(username=username, password=password, host=host, port=port)
+    if receiver:
+        try:
+            receivers = [parseReceiver(spec) for spec in receiver]
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--receiver')
+    else:
+        receivers = [Receiver('{}:{}'.format(host, port), getAPIRoot(
+            username=username, password=password, host=host, port=port), bouquet)]
+    api_root_url = receivers[0].api_root_url
+    session = setSession(createSession(timeout=timeout,
+        retries=retries, pool_size=workers))
+
+    if list_bouquets or list_services:
+        listBouquets(receivers, list_services)
+        return
+
+    if targets:
+        if serve:
+            raise click.BadParameter(u"can't be used with --serve",
+                param_hint='--targets')
+        import yaml
+        try:
+            targets = loadTargets(targets, continuous_numbering, category_override)
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            raise click.BadParameter(str(e), param_hint='--targets')
+        # Only fetch the bouquets the targets need
+        if len(receivers) == 1 and not receivers[0].bouquet:
+            receivers[0] = receivers[0]._replace(bouquet=targetsBouquets(targets))
+
+    if days is not None and days <= 0:
+        raise click.BadParameter(u"must be greater than 0", param_hint='--days')
+
+    if on_failure == 'reuse' and (no_cache or not cache_dir):
+        raise click.BadParameter(u"needs the EPG cache, can't be used with "
+            u"--no-cache", param_hint='--on-failure')
+
+    profiler = PhaseProfiler(profile_dir) if profile_dir else None
+    metrics = RunMetrics(profiler)
+    session.hooks['response'].append(lambda r, *args, **kwargs:
+        metrics.observeResponse(r, *args, **kwargs))
+
+    caches = {}
+    fragment_cache = None
+    if not no_cache and cache_dir:
+        caches = dict((r.name, EPGCache(cache_dir, cache_ttl, r.name)) for r in receivers)
+        fragment_cache = FragmentCache(cache_dir, cache_ttl)
+
+    # The governors are kept across refreshes in serve mode
+    governors = {}
+    if adaptive or max_rps:
+        governors = dict((r.name, ConcurrencyGovernor(workers, max_rps, adaptive))
+            for r in receivers)
+
+    def retrieve(metrics):
+        window = makeEPGWindow(from_time, days)
+        if len(receivers) > 1:
+            bouquets_services, epg, failures = retrieveFederatedEPG(receivers,
+                list_bouquets, workers, fetch_mode, caches, metrics, window, governors)
+        else:
+            bouquets_services, epg, failures = retrieveEPG(receivers[0].bouquet,
+                api_root_url, list_bouquets, workers, fetch_mode,
+                caches.get(receivers[0].name), metrics, window,
+                governors.get(receivers[0].name))
+        # The events reused for the failed services are normalised too
+        bouquets_services, epg, failed_summary = resolveFailures(bouquets_services,
+            epg, failures, on_failure, list(caches.values()), window)
+        epg = normaliseEPG(epg, overlaps, fill_gaps, metrics)
+        return bouquets_services, epg, failed_summary
+
+    if serve:
+        publisher = XMLTVPublisher()
+
+        def refresh():
+            nonlocal metrics
+            metrics = RunMetrics(profiler)
+            bouquets_services, epg, failed_summary = retrieve(metrics)
+            if failed_summary and on_failure == 'abort':
+                logger.error(u"Keeping the served XMLTV")
+                metrics.write(metrics_file, prometheus_file)
+                return
+            overrides_mtime = None
+            if category_override:
+                overrides_mtime = os.path.getmtime(category_override)
+            digest = digestEPG(bouquets_services, epg, continuous_numbering,
+                category_override, overrides_mtime)
+            if digest == publisher.digest:
+                logger.info(u"The EPG hasn't changed, keeping the served XMLTV")
+            else:
+                if fragment_cache:
+                    cache_stats = fragment_cache.stats.copy()
+                with metrics.phase('render'):
+                    xmltv = generateXMLTV(bouquets_services, epg, api_root_url,
+                        continuous_numbering, category_override, jobs, fragment_cache)
+                    publisher.publish(codecs.BOM_UTF8 + xmltv.encode('utf-8'), digest)
+                if fragment_cache:
+                    for stat in ('hits', 'misses'):
+                        metrics.count('render_cache_' + stat,
+                            fragment_cache.stats[stat] - cache_stats[stat])
+                logger.info(u"Boom!")
+            metrics.write(metrics_file, prometheus_file)
+
+        serveEPG(refresh, publisher, serve_address, serve_port, refresh_interval)
+        for cache in list(caches.values()) + [fragment_cache]:
+            if cache:
+                cache.close()
+        return
 
     # Retrieve Data from OpenWebIf
-    bouquets = getBouquets(bouquet=bouquet, api_root_url=api_root_url,
-        list_bouquets=list_bouquets)
-    bouquets_services = getBouquetsServices(bouquets=bouquets, api_root_url=api_root_url)
-    epg = getEPGs(bouquets_services=bouquets_services, api_root_url=api_root_url)
-    tzoffset = getOffset(api_root_url=api_root_url)
+    bouquets_services, epg, failed_summary = retrieve(metrics)
+    for cache in caches.values():
+        cache.close()
+    if failed_summary and on_failure == 'abort':
+        if fragment_cache:
+            fragment_cache.close()
+        metrics.write(metrics_file, prometheus_file)
+        click.echo(failed_summary, err=True)
+        sys.exit(EXIT_INCOMPLETE)
 
     # Generate the XMLTV file 
-    xmltv = generateXMLTV(
-        bouquets_services, epg, api_root_url, tzoffset, continuous_numbering,
-        category_override)
-    logger.info(u"Saving XMLTV payload to file {}".format(output_file))
     try:
-        with codecs.open(output_file, 'w', 'utf-8-sig') as xmltv_file:
-            xmltv_file.write(xmltv)
-            logger.info(u"Boom!")
+        if targets:
+            writeTargets(targets, bouquets_services, epg, api_root_url, jobs,
+                metrics, fragment_cache)
+        else:
+            writeXMLTV(output_file, bouquets_services, epg, api_root_url,
+                continuous_numbering, category_override, jobs, metrics,
+                fragment_cache)
+        if fragment_cache:
+            fragment_cache.close()
+        metrics.write(metrics_file, prometheus_file)
+        logger.info(u"Boom!")
     except Exception:
         logger.error(u"Uh-oh! Something's happened ...")
         raise
+    if failed_summary:
+        click.echo(failed_summary, err=True)
+        sys.exit(EXIT_INCOMPLETE)
 
 if __name__ == '__main__':
     main()
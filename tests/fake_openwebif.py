@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Synthetic OpenWebif server for the end to end tests and the benchmarks.
+
+It generates a configurable number of bouquets, services per bouquet and
+events per service and answers the OpenWebif API endpoints used by owi2plex:
+/api/bouquets, /api/getservices, /api/epgservice and /api/epgbouquet. Latency
+and server errors can be injected in every request or in the ones of the
+services in failing, the events of the services in truncated can be cut
+short in the bouquet responses, and the latency grows
+with the requests in flight beyond the capacity of the box when given.
+
+Usage: python tests/fake_openwebif.py --bouquets 3 --services 100 --events 300
+"""
+import argparse
+import gzip
+import json
+import random
+import threading
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+TITLES = [
+    'News: Six One', 'BBC News', 'Doctor Who', 'Champions League Live',
+    'The NFL Show', 'Coronation Street', 'Fair City', 'Top Gear', 'Nationwide',
+    'Home and Away', 'The Simpsons', 'New: Line of Duty', 'Film: Jaws',
+]
+SHORTDESCS = [
+    '[News] The latest national and international news.',
+    '[Drama] The Timeless Child. (S12 Ep{episode}/10)',
+    '[Sport. Football] Live coverage of the match.',
+    '{episode}/6. A new arrival causes trouble.',
+    '[Movie] Thriller {day:02}/06/1975',
+    '[Entertainment] Presenters review the latest cars.',
+    '',
+]
+LONGDESCS = [
+    '',
+    'A longer description of the programme.',
+    'A shark terrorises a beach town.\nSteven Spielberg\nRoy Scheider\nRobert Shaw\n',
+]
+DURATIONS = [5, 30, 30, 60, 60, 90, 120]
+
+
+class FakeOpenWebif(object):
+    """
+    Fake OpenWebif API with bouquets * services * events generated from the
+    seed. Services are shared between consecutive bouquets when overlap is
+    greater than 0, like the "Last Scanned" and favourites bouquets do.
+    """
+    def __init__(self, bouquets=2, services=10, events=20, latency=0.0,
+            error_rate=0.0, overlap=0, seed=0, start=None, capacity=None):
+        self.latency = latency
+        self.capacity = capacity
+        self.failing = set()
+        # {"sRef": number of events returned by /api/epgbouquet}
+        self.truncated = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.start = start or int(datetime.now().timestamp()) // 1800 * 1800
+        self.server = None
+        self.thread = None
+
+        self.bouquets = []
+        self.services = {}
+        self.events = {}
+        for b in range(bouquets):
+            bouquet_ref = ('1:7:1:0:0:0:0:0:0:0:FROM BOUQUET "userbouquet.fake{}.tv" '
+                'ORDER BY bouquet'.format(b))
+            self.bouquets.append([bouquet_ref, 'Bouquet {}'.format(b)])
+            first = b * (services - overlap)
+            self.services[bouquet_ref] = [self.service(first + s, s + 1)
+                for s in range(services)]
+            for service in self.services[bouquet_ref]:
+                if service['servicereference'] not in self.events:
+                    self.events[service['servicereference']] = self.serviceEvents(
+                        service, events)
+
+    def service(self, index, pos):
+        sid = 0x1000 + index
+        return {
+            'servicereference': '1:0:19:{:X}:802:2:11A0000:0:0:0:'.format(sid),
+            'servicename': 'Channel {}'.format(index),
+            'program': sid,
+            'pos': pos,
+        }
+
+    def serviceEvents(self, service, events):
+        result = []
+        begin = self.start
+        picon = '/picon/{}.png'.format(
+            service['servicereference'].rstrip(':').replace(':', '_'))
+        for e in range(events):
+            duration = self.random.choice(DURATIONS)
+            result.append({
+                'id': e + 1,
+                'sref': service['servicereference'],
+                'sname': service['servicename'],
+                'begin_timestamp': begin,
+                'duration': duration,
+                'duration_sec': duration * 60,
+                'title': self.random.choice(TITLES),
+                'shortdesc': self.random.choice(SHORTDESCS).format(
+                    episode=self.random.randint(1, 10), day=self.random.randint(1, 28)),
+                'longdesc': self.random.choice(LONGDESCS),
+                'picon': picon,
+            })
+            begin += duration * 60
+        return result
+
+    def api(self, path, query):
+        """
+        Returns the JSON response of an API endpoint or None if unknown.
+        """
+        if path == '/api/bouquets':
+            return {'bouquets': self.bouquets}
+        if path == '/api/getservices':
+            return {'services': self.services.get(query.get('sRef'), []), 'result': True}
+        if path == '/api/epgservice':
+            events = self.events.get(query.get('sRef'), [])
+            return {'events': self.window(events, query), 'result': True}
+        if path == '/api/epgbouquet':
+            events = []
+            for service in self.services.get(query.get('bRef'), []):
+                sref = service['servicereference']
+                service_events = self.window(self.events[sref], query)
+                if 'endTime' not in query:
+                    # Like OpenWebif, only the current event without an end
+                    service_events = self.window(self.events[sref], dict(
+                        time=query.get('time', int(time.time())), endTime=0))[:1]
+                for event in service_events[:self.truncated.get(sref)]:
+                    event = dict(event)
+                    del event['duration']
+                    events.append(event)
+            return {'events': events, 'result': True}
+        return None
+
+    def window(self, events, query):
+        # Like enigma2's EPG lookup endTime is a number of minutes after time
+        begin = int(query.get('time', -1))
+        minutes = int(query.get('endTime', -1))
+        end = max(begin, 0) + minutes * 60 if minutes >= 0 else -1
+        return [e for e in events
+            if (begin < 0 or e['begin_timestamp'] + e['duration'] * 60 > begin)
+            and (end < 0 or e['begin_timestamp'] < end)]
+
+    def handler(self):
+        fake = self
+
+        class FakeOpenWebifHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+                with fake.lock:
+                    fake.requests += 1
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                    is_error = (fake.random.random() < fake.error_rate
+                        or query.get('sRef') in fake.failing)
+                    if is_error:
+                        fake.errors += 1
+                    # Every request beyond the capacity adds up to the latency
+                    overload = max(0, fake.in_flight - fake.capacity) if fake.capacity else 0
+                try:
+                    self.respond(url, query, is_error, (1 + overload) * fake.latency)
+                finally:
+                    with fake.lock:
+                        fake.in_flight -= 1
+
+            def respond(self, url, query, is_error, latency):
+                if latency:
+                    time.sleep(latency)
+                data = None if is_error else fake.api(url.path, query)
+                if is_error:
+                    self.send(500, b'Internal Server Error')
+                elif data is None:
+                    self.send(404, b'Not Found')
+                else:
+                    self.send(200, json.dumps(data).encode('utf-8'), 'application/json')
+
+            def send(self, status, body, content_type='text/plain'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body, compresslevel=1)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeOpenWebifHandler
+
+    def serve(self, address='127.0.0.1', port=0):
+        """
+        Starts serving in a background thread. Returns the root URL.
+        """
+        self.server = ThreadingHTTPServer((address, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', default=8001, type=int)
+    parser.add_argument('--bouquets', default=2, type=int)
+    parser.add_argument('--services', default=10, type=int)
+    parser.add_argument('--events', default=20, type=int)
+    parser.add_argument('--overlap', default=0, type=int)
+    parser.add_argument('--latency', default=0.0, type=float,
+        help='Seconds added to every request.')
+    parser.add_argument('--error-rate', default=0.0, type=float,
+        help='Fraction of the requests answered with a 500.')
+    parser.add_argument('--capacity', type=int,
+        help='Requests in flight the box handles without slowing down.')
+    args = parser.parse_args()
+    fake = FakeOpenWebif(args.bouquets, args.services, args.events, args.latency,
+        args.error_rate, args.overlap, capacity=args.capacity)
+    print('Serving fake OpenWebif on {}'.format(fake.serve(args.address, args.port)))
+    try:
+        fake.thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
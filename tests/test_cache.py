@@ -0,0 +1,92 @@
+from unittest.mock import Mock
+
+from owi2plex import (EPGCache, EPGWindow, compactEvents, getBouquetsServices,
+    getEPGs)
+
+
+NOW = 1571320000
+
+
+def test_EPGCache_services(tmpdir, bouquets_services):
+    cache = EPGCache(str(tmpdir), 3600, 'openwebif.server:80')
+    assert cache.getServices('bRef', now=NOW) is None
+    cache.putServices('bRef', bouquets_services['TV'], now=NOW)
+    assert cache.getServices('bRef', now=NOW + 3600) == bouquets_services['TV']
+    assert cache.getServices('bRef', now=NOW + 3601) is None
+    other_receiver = EPGCache(str(tmpdir), 3600, 'other.server:80')
+    assert other_receiver.getServices('bRef', now=NOW) is None
+    assert cache.stats['services_hits'] == 1
+    assert cache.stats['services_misses'] == 2
+
+
+def test_EPGCache_events(tmpdir, epgservice_api_call):
+    sref = '1:0:19:1B1D:802:2:11A0000:0:0:0:'
+    events = compactEvents(epgservice_api_call(sref)['events'])
+    cache = EPGCache(str(tmpdir), 3600, 'openwebif.server:80')
+    cache.putEvents(sref, events, now=NOW)
+    assert cache.getEvents(sref, now=NOW + 60) == events
+    assert cache.getEvents(sref, now=NOW + 60).picon == events.picon
+    # Stale after the TTL
+    assert cache.getEvents(sref, now=NOW + 3601) is None
+    # The first event ends at 1571326200 and the second one at 1571329800
+    assert cache.expire(now=1571326200) == 1
+    assert cache.getEvents(sref, now=NOW + 60) == events[1:]
+    assert cache.expire(now=1571329800) == 1
+    assert cache.getEvents(sref, now=NOW + 60) is None
+
+
+def test_EPGCache_events_window(tmpdir, epgservice_api_call):
+    sref = '1:0:19:1B1D:802:2:11A0000:0:0:0:'
+    events = compactEvents(epgservice_api_call(sref)['events'])
+    cache = EPGCache(str(tmpdir), 3600, 'openwebif.server:80')
+    cache.putEvents(sref, events, now=NOW, window=EPGWindow(NOW + 600, NOW + 86400))
+    assert cache.getEvents(sref, now=NOW, window=EPGWindow(NOW + 600, NOW + 3600)) == events
+    # Events fetched for a narrower window aren't enough
+    assert cache.getEvents(sref, now=NOW, window=EPGWindow(NOW + 600, NOW + 86401)) is None
+    assert cache.getEvents(sref, now=NOW, window=EPGWindow(NOW + 60, NOW + 3600)) is None
+    assert cache.getEvents(sref, now=NOW) is None
+    # Unless the beginning of the window has already gone by
+    assert cache.getEvents(sref, now=NOW + 600, window=EPGWindow(NOW, NOW + 3600)) == events
+
+
+def test_EPGCache_migration(tmpdir):
+    import sqlite3
+    db = sqlite3.connect(str(tmpdir.join('owi2plex.sqlite')))
+    db.execute('CREATE TABLE epg_services (receiver TEXT, sref TEXT, '
+        'fetched_at REAL, PRIMARY KEY (receiver, sref))')
+    db.commit()
+    db.close()
+    cache = EPGCache(str(tmpdir), 3600, 'openwebif.server:80')
+    cache.putEvents('sref', [], now=NOW, window=EPGWindow(NOW, None))
+
+
+def test_getBouquetsServices_cached(tmpdir, bouquets_services, openwebif_server):
+    cache = EPGCache(str(tmpdir), 3600, 'openwebif.server:80')
+    session = Mock()
+    session.get.return_value.json.return_value = {'services': bouquets_services['TV']}
+    for _ in range(2):
+        services = getBouquetsServices({'TV': 'bRef'}, openwebif_server,
+            session=session, cache=cache)
+        assert services == {'TV': bouquets_services['TV']}
+    assert session.get.call_count == 1
+
+
+def test_getEPGs_cached(tmpdir, bouquets_services, epgservice_api_call,
+        openwebif_server, json_response):
+    cache = EPGCache(str(tmpdir), 3600, 'openwebif.server:80')
+    cache.putEvents('1:0:19:1B1E:802:2:11A0000:0:0:0:',
+        epgservice_api_call('1:0:19:1B1E:802:2:11A0000:0:0:0:')['events'], now=NOW)
+    session = Mock()
+    session.get.side_effect = lambda url, **kwargs: json_response(
+        epgservice_api_call(url.split('sRef=')[1]))
+
+    cache.getEvents = Mock(wraps=lambda sref, window=None: EPGCache.getEvents(
+        cache, sref, now=NOW, window=window))
+    epg = getEPGs(bouquets_services, openwebif_server, session=session, cache=cache)
+    assert list(epg.keys()) == [6941, 6942, 6943]
+    assert session.get.call_count == 2
+    assert cache.stats['epg_hits'] == 1
+
+    epg = getEPGs(bouquets_services, openwebif_server, session=session, cache=cache)
+    assert session.get.call_count == 2
+    assert cache.stats['epg_hits'] == 4
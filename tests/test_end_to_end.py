@@ -0,0 +1,292 @@
+import json
+import os
+import subprocess
+import sys
+
+from click.testing import CliRunner
+from lxml import etree
+
+import owi2plex
+
+
+def _run_main(tmpdir, monkeypatch, fake, *args):
+    monkeypatch.chdir(str(tmpdir))
+    output_file = str(tmpdir.join('epg.xml'))
+    result = CliRunner().invoke(owi2plex.main, [
+        '-h', fake.host, '-P', str(fake.port), '-o', output_file, '--no-cache',
+        '-r', '2'] + list(args))
+    assert result.exit_code == 0, result.output
+    with open(output_file, 'rb') as f:
+        return etree.fromstring(f.read().decode('utf-8-sig').encode('utf-8'))
+
+
+def test_main_fake_openwebif(tmpdir, monkeypatch, fake_openwebif):
+    fake = fake_openwebif(bouquets=3, services=5, events=8, overlap=2)
+    xmltv = _run_main(tmpdir, monkeypatch, fake)
+    assert len(xmltv.findall('channel')) == 15
+    # Services shared by two bouquets are only written and requested once
+    assert len(xmltv.findall('programme')) == 11 * 8
+    assert fake.requests == 1 + 3 + 11
+
+
+def _upcoming():
+    from datetime import datetime
+    return int(datetime.now().timestamp()) // 1800 * 1800 + 3600
+
+
+def test_main_fake_openwebif_bouquet_mode(tmpdir, monkeypatch, fake_openwebif):
+    # The bulk endpoint is asked for the events from now on
+    fake = fake_openwebif(bouquets=2, services=5, events=8, start=_upcoming())
+    xmltv = _run_main(tmpdir, monkeypatch, fake, '-m', 'bouquet', '-b', 'Bouquet 1')
+    assert len(xmltv.findall('channel')) == 5
+    assert len(xmltv.findall('programme')) == 5 * 8
+    assert fake.requests == 1 + 1 + 1
+
+
+def test_main_fake_openwebif_bouquet_mode_truncated(tmpdir, monkeypatch, fake_openwebif):
+    fake = fake_openwebif(bouquets=1, services=6, events=60, start=_upcoming())
+    services = fake.services[fake.bouquets[0][0]]
+    # Only the current event of one service and a few hours of another
+    fake.truncated = {services[1]['servicereference']: 1,
+        services[4]['servicereference']: 5}
+    xmltv = _run_main(tmpdir, monkeypatch, fake, '-m', 'bouquet')
+    assert len(xmltv.findall('programme')) == 6 * 60
+    assert fake.requests == 1 + 1 + 1 + 2
+
+
+def test_main_fake_openwebif_errors(tmpdir, monkeypatch, fake_openwebif):
+    monkeypatch.setattr(owi2plex, 'createSession', _no_backoff(owi2plex.createSession))
+    fake = fake_openwebif(bouquets=1, services=10, events=4, error_rate=0.2, seed=3)
+    xmltv = _run_main(tmpdir, monkeypatch, fake, '-r', '5')
+    assert fake.errors > 0
+    assert len(xmltv.findall('programme')) == 10 * 4
+
+
+def _no_backoff(create_session):
+    def create_session_no_backoff(timeout=30, retries=3, backoff_factor=0.5, pool_size=10):
+        return create_session(timeout, retries, 0, pool_size)
+    return create_session_no_backoff
+
+
+def test_main_fake_openwebif_metrics(tmpdir, monkeypatch, fake_openwebif):
+    fake = fake_openwebif(bouquets=2, services=3, events=5)
+    metrics_file = str(tmpdir.join('metrics.json'))
+    prometheus_file = str(tmpdir.join('owi2plex.prom'))
+    _run_main(tmpdir, monkeypatch, fake, '--metrics-file', metrics_file,
+        '--prometheus-file', prometheus_file)
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    assert set(metrics['phases']) == {'bouquets', 'services', 'epg', 'render', 'write'}
+    assert metrics['requests']['count'] == fake.requests
+    assert metrics['requests']['bytes_received'] > 0
+    assert metrics['counts']['channels'] == 6
+    assert metrics['counts']['events'] == 30
+    with open(prometheus_file) as f:
+        assert 'owi2plex_events 30' in f.read().splitlines()
+
+
+def test_main_fake_openwebif_window(tmpdir, monkeypatch, fake_openwebif):
+    from datetime import datetime
+    start = int(datetime(2030, 1, 1).timestamp())
+    fake = fake_openwebif(bouquets=1, services=3, events=40, start=start)
+    xmltv = _run_main(tmpdir, monkeypatch, fake, '--from', '2030-01-01 06:00',
+        '--days', '0.25')
+    begin, end = start + 6 * 3600, start + 12 * 3600
+    expected = [e for events in fake.events.values() for e in events
+        if e['begin_timestamp'] + e['duration'] * 60 > begin
+        and e['begin_timestamp'] < end]
+    assert 0 < len(expected) < 3 * 40
+    assert len(xmltv.findall('programme')) == len(expected)
+
+
+def test_main_days_not_positive(tmpdir, monkeypatch, fake_openwebif):
+    monkeypatch.chdir(str(tmpdir))
+    fake = fake_openwebif(bouquets=1, services=2, events=4)
+    for days in ('-1', '0'):
+        result = CliRunner().invoke(owi2plex.main, ['-h', fake.host, '-P',
+            str(fake.port), '-o', str(tmpdir.join('epg.xml')), '--days', days])
+        assert result.exit_code == 2
+    assert 'must be greater than 0' in result.output
+    assert fake.requests == 0
+    assert not tmpdir.join('epg.xml').exists()
+
+
+def test_main_fake_openwebif_adaptive(tmpdir, monkeypatch, fake_openwebif):
+    fake = fake_openwebif(bouquets=1, services=30, events=4, latency=0.01, capacity=2)
+    metrics_file = str(tmpdir.join('metrics.json'))
+    xmltv = _run_main(tmpdir, monkeypatch, fake, '-w', '8', '--adaptive',
+        '--max-rps', '500', '--metrics-file', metrics_file)
+    assert len(xmltv.findall('programme')) == 30 * 4
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    assert 1 <= metrics['counts']['concurrency'] <= 8
+    assert fake.max_in_flight <= 8
+
+
+def test_main_fake_openwebif_profile(tmpdir, monkeypatch, fake_openwebif):
+    import tracemalloc
+    fake = fake_openwebif(bouquets=1, services=3, events=5)
+    try:
+        _run_main(tmpdir, monkeypatch, fake, '--profile', 'profile')
+    finally:
+        tracemalloc.stop()
+    report = tmpdir.join('profile', 'report.txt').read()
+    for phase in ('bouquets', 'services', 'epg', 'render', 'write'):
+        assert tmpdir.join('profile', '{}.prof'.format(phase)).check()
+        assert '== {} ('.format(phase) in report
+    assert 'addServiceEvents2XML' in report.split('== render')[1]
+
+
+def _run_receivers(tmpdir, monkeypatch, *fakes):
+    monkeypatch.chdir(str(tmpdir))
+    output_file = str(tmpdir.join('epg.xml'))
+    args = ['-o', output_file, '--no-cache', '-r', '2']
+    for fake in fakes:
+        args += ['-R', '{}:{}'.format(fake.host, fake.port)]
+    result = CliRunner().invoke(owi2plex.main, args)
+    assert result.exit_code == 0, result.output
+    with open(output_file, 'rb') as f:
+        return etree.fromstring(f.read().decode('utf-8-sig').encode('utf-8'))
+
+
+def test_main_fake_openwebif_receivers(tmpdir, monkeypatch, fake_openwebif):
+    # The first 6 services of both receivers are the same
+    fake_a = fake_openwebif(bouquets=1, services=6, events=4)
+    fake_b = fake_openwebif(bouquets=1, services=10, events=4)
+    xmltv = _run_receivers(tmpdir, monkeypatch, fake_a, fake_b)
+    assert len(xmltv.findall('channel')) == 10
+    assert len(xmltv.findall('programme')) == 10 * 4
+    # Every service is only requested once, spread across both receivers
+    assert fake_a.requests == 1 + 1 + 5
+    assert fake_b.requests == 1 + 1 + 5
+    icons = [icon.attrib['src'] for icon in xmltv.iter('icon')]
+    assert len(icons) == 10
+    assert sum(icon.startswith(fake_b.url) for icon in icons) == 5
+
+
+def test_main_fake_openwebif_receivers_fallback(tmpdir, monkeypatch, fake_openwebif):
+    fake_a = fake_openwebif(bouquets=1, services=6, events=4)
+    fake_b = fake_openwebif(bouquets=1, services=10, events=0)
+    xmltv = _run_receivers(tmpdir, monkeypatch, fake_b, fake_a)
+    assert len(xmltv.findall('channel')) == 10
+    # The shared services without events in fake_b are taken from fake_a
+    assert len(xmltv.findall('programme')) == 6 * 4
+
+
+def test_main_list_bouquets(tmpdir, monkeypatch, fake_openwebif):
+    monkeypatch.chdir(str(tmpdir))
+    fake = fake_openwebif(bouquets=3, services=4, events=5)
+    result = CliRunner().invoke(owi2plex.main, ['-h', fake.host, '-P', str(fake.port), '-l'])
+    assert result.exit_code == 0, result.output
+    assert result.output.splitlines() == ['Bouquet 0', 'Bouquet 1', 'Bouquet 2']
+    assert fake.requests == 1
+    assert not tmpdir.join('epg.xml').check()
+
+    result = CliRunner().invoke(owi2plex.main, ['-h', fake.host, '-P', str(fake.port),
+        '-b', 'Bouquet 1', '--list-services'])
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[0] == 'Bouquet 1'
+    assert lines[1].split() == ['1.', 'Channel', '4', '(4100)']
+    assert len(lines) == 1 + 4
+    assert fake.requests == 1 + 2
+
+
+def test_startup_lazy_imports():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c',
+        'import sys, owi2plex; print(owi2plex.__version__); '
+        'print(" ".join(m for m in ("requests", "lxml.etree", "yaml", "sqlite3", '
+        '"http.server", "email.utils") '
+        'if m in sys.modules))'], cwd=root).decode('utf-8').splitlines()
+    assert output == [owi2plex.getVersion(), '']
+
+
+def _run_failing(tmpdir, fake, *args):
+    output_file = str(tmpdir.join('epg.xml'))
+    result = CliRunner().invoke(owi2plex.main, [
+        '-h', fake.host, '-P', str(fake.port), '-o', output_file, '-r', '0',
+        '--cache-dir', str(tmpdir.join('cache'))] + list(args))
+    xmltv = None
+    if os.path.exists(output_file):
+        with open(output_file, 'rb') as f:
+            xmltv = etree.fromstring(f.read().decode('utf-8-sig').encode('utf-8'))
+    return result, xmltv
+
+
+def test_main_fake_openwebif_resume(tmpdir, monkeypatch, fake_openwebif):
+    monkeypatch.chdir(str(tmpdir))
+    fake = fake_openwebif(bouquets=1, services=6, events=4)
+    failing = [s['servicereference'] for s in fake.services[fake.bouquets[0][0]][4:]]
+    fake.failing.update(failing)
+    result, xmltv = _run_failing(tmpdir, fake)
+    assert result.exit_code == owi2plex.EXIT_INCOMPLETE
+    assert "EPG couldn't be retrieved for 2 of 6 services" in result.output
+    assert 'Channel 4 (4100)' in result.output
+    assert len(xmltv.findall('channel')) == 6
+    assert len(xmltv.findall('programme')) == 4 * 4
+
+    # The services retrieved are checkpointed, so only the failed ones are requested
+    fake.failing.clear()
+    requests = fake.requests
+    result, xmltv = _run_failing(tmpdir, fake)
+    assert result.exit_code == 0, result.output
+    assert fake.requests - requests == 1 + 2
+    assert len(xmltv.findall('programme')) == 6 * 4
+
+
+def test_main_fake_openwebif_on_failure(tmpdir, monkeypatch, fake_openwebif):
+    monkeypatch.chdir(str(tmpdir))
+    fake = fake_openwebif(bouquets=1, services=6, events=4)
+    result, _ = _run_failing(tmpdir, fake)
+    assert result.exit_code == 0, result.output
+    with open(str(tmpdir.join('epg.xml')), 'rb') as f:
+        previous = f.read()
+
+    fake.failing.add(fake.services[fake.bouquets[0][0]][5]['servicereference'])
+    result, xmltv = _run_failing(tmpdir, fake, '--cache-ttl', '0', '--on-failure', 'reuse')
+    assert result.exit_code == owi2plex.EXIT_INCOMPLETE
+    assert '1 of their channels have their last good programmes' in result.output
+    assert len(xmltv.findall('programme')) == 6 * 4
+
+    result, xmltv = _run_failing(tmpdir, fake, '--cache-ttl', '0', '--on-failure', 'omit')
+    assert result.exit_code == owi2plex.EXIT_INCOMPLETE
+    assert len(xmltv.findall('channel')) == 5
+    assert len(xmltv.findall('programme')) == 5 * 4
+
+    with open(str(tmpdir.join('epg.xml')), 'wb') as f:
+        f.write(previous)
+    result, _ = _run_failing(tmpdir, fake, '--cache-ttl', '0', '--on-failure', 'abort')
+    assert result.exit_code == owi2plex.EXIT_INCOMPLETE
+    assert 'nothing has been written' in result.output
+    with open(str(tmpdir.join('epg.xml')), 'rb') as f:
+        assert f.read() == previous
+
+
+def test_main_fake_openwebif_on_failure_reuse_normalised(tmpdir, monkeypatch,
+        fake_openwebif):
+    monkeypatch.chdir(str(tmpdir))
+    fake = fake_openwebif(bouquets=1, services=2, events=4, start=_upcoming())
+    for events in fake.events.values():
+        for n, event in enumerate(events):
+            event['begin_timestamp'] += n * 600
+    result, _ = _run_failing(tmpdir, fake)
+    assert result.exit_code == 0, result.output
+
+    # The events reused from the cache get the gaps filled like the others
+    fake.failing.add(fake.services[fake.bouquets[0][0]][1]['servicereference'])
+    result, xmltv = _run_failing(tmpdir, fake, '--cache-ttl', '0', '--on-failure',
+        'reuse', '--fill-gaps', '1')
+    assert result.exit_code == owi2plex.EXIT_INCOMPLETE
+    titles = [p.find('title').text for p in xmltv.findall('programme')]
+    assert titles.count(owi2plex.GAP_TITLE) == 2 * 3
+
+
+def test_main_on_failure_reuse_no_cache(tmpdir, monkeypatch, fake_openwebif):
+    monkeypatch.chdir(str(tmpdir))
+    fake = fake_openwebif(bouquets=1, services=2, events=4)
+    result = CliRunner().invoke(owi2plex.main, ['-h', fake.host, '-P', str(fake.port),
+        '-o', str(tmpdir.join('epg.xml')), '--no-cache', '--on-failure', 'reuse'])
+    assert result.exit_code == 2
+    assert "can't be used with --no-cache" in result.output
+    assert fake.requests == 0
@@ -0,0 +1,71 @@
+import collections
+
+import pytest
+
+from owi2plex import (Event, EventIndex, ChannelEvents, normaliseEvents,
+    normaliseEPG, filterEvents, EPGWindow, GAP_TITLE)
+
+
+def _event(begin_minute, duration, title='News', id=None):
+    return Event(id, 1571320800 + begin_minute * 60, duration, title, u'', u'')
+
+
+def _times(events):
+    return [((e.begin_timestamp - 1571320800) // 60, e.duration) for e in events]
+
+
+def test_EventIndex_range():
+    # The film overlaps the news and the weather, and the events are unsorted
+    events = [_event(60, 30), _event(0, 30), _event(30, 120, 'Film'), _event(90, 10)]
+    index = EventIndex(events)
+    assert _times(index.events) == [(0, 30), (30, 120), (60, 30), (90, 10)]
+    assert _times(index.range()) == _times(index.events)
+    assert _times(index.range(_event(100, 0).begin_timestamp)) == [(30, 120)]
+    assert _times(index.range(_event(25, 0).begin_timestamp,
+        _event(60, 0).begin_timestamp)) == [(0, 30), (30, 120)]
+    assert index.range(_event(150, 0).begin_timestamp) == []
+    assert _times(filterEvents(ChannelEvents(events, 'picon'), EPGWindow(
+        _event(95, 0).begin_timestamp, None))) == [(30, 120), (90, 10)]
+
+
+@pytest.mark.parametrize('overlaps,expected', [
+    ('keep', [(0, 30), (30, 120), (60, 30), (150, 30)]),
+    ('trim', [(0, 30), (30, 30), (60, 30), (150, 30)]),
+    ('drop', [(0, 30), (30, 120), (150, 30)]),
+])
+def test_normaliseEvents(overlaps, expected):
+    events = ChannelEvents([_event(0, 30), _event(30, 120, 'Film'), _event(60, 30),
+        _event(0, 30, id=7), _event(150, 30)], '/picon/1.png')
+    stats = collections.Counter()
+    normalised = normaliseEvents(events, overlaps, stats=stats)
+    assert _times(normalised) == expected
+    assert normalised.picon == '/picon/1.png'
+    assert stats == {'duplicates': 1, 'overlaps': 1}
+    # The events are copied when they're trimmed
+    assert events[1].duration == 120
+
+
+def test_normaliseEvents_trim_same_begin():
+    events = [_event(0, 10, 'Short'), _event(0, 60, 'Long'), _event(30, 30)]
+    assert [e.title for e in normaliseEvents(events, 'trim')] == ['Long', 'News']
+    assert _times(normaliseEvents(events, 'trim')) == [(0, 30), (30, 30)]
+
+
+def test_normaliseEvents_fill_gaps():
+    events = [_event(0, 30), _event(35, 25), _event(120, 30), _event(130, 10)]
+    stats = collections.Counter()
+    normalised = normaliseEvents(events, fill_gaps=15, stats=stats)
+    assert _times(normalised) == [(0, 30), (35, 25), (60, 60), (120, 30), (130, 10)]
+    assert normalised[2].title == GAP_TITLE
+    assert stats['gaps'] == 1
+    # Events within another one don't leave a gap after them
+    assert _times(normaliseEvents(events, 'drop', fill_gaps=5)) == [
+        (0, 30), (30, 5), (35, 25), (60, 60), (120, 30)]
+
+
+def test_normaliseEPG():
+    epg = collections.OrderedDict([(2, [_event(0, 30), _event(0, 30)]), (1, [])])
+    normalised = normaliseEPG(epg, 'trim')
+    assert list(normalised.keys()) == [2, 1]
+    assert _times(normalised[2]) == [(0, 30)]
+    assert normalised[1] == []
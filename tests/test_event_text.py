@@ -0,0 +1,49 @@
+from datetime import date
+
+from owi2plex import parseEventText, parseSEP
+
+
+def test_parseSEP_styles():
+    assert parseSEP('The Timeless Child. (S12 Ep10/10)') == (True, '11.9.9', False)
+    assert parseSEP('3/6. A new arrival.') == (True, '0.2.5', False)
+    assert parseSEP('Ep 2') == (True, '.1.', True)
+    assert parseSEP('No numbers here') == (False, '..', False)
+
+
+def test_parseEventText_series():
+    event_text = parseEventText('New: Doctor Who',
+        '[Drama] The Timeless Child. (S12 Ep10/10)', 'The Doctor faces the Master.')
+    assert event_text.title == 'Doctor Who'
+    assert event_text.desc == 'The Doctor faces the Master.'
+    assert event_text.subtitle == 'The Timeless Child.'
+    assert event_text.categories == ('Drama',)
+    assert (event_text.match_epnum, event_text.epnum) == (True, '11.9.9')
+    assert event_text.original_air_date is None
+    assert event_text.credits is None
+
+
+def test_parseEventText_movie():
+    event_text = parseEventText('Jaws &amp; more',
+        '[Movie] Thriller 20/06/1975', 'A shark.\nSteven Spielberg\nRoy Scheider\nRobert Shaw\n')
+    assert event_text.title == 'Jaws & more'
+    assert event_text.categories == ('Movie',)
+    assert event_text.original_air_date == '1975-06-20'
+    assert event_text.original_air_dt == date(1975, 6, 20)
+    assert event_text.credits == ('Steven Spielberg', ('Roy Scheider', 'Robert Shaw'))
+
+
+def test_parseEventText_empty_shortdesc():
+    event_text = parseEventText('Film', '', '[Movie. Drama] 31/02/2001')
+    # Categories and dates come from the long description, invalid dates are kept
+    assert event_text.categories == ('Movie', 'Drama')
+    assert event_text.subtitle is None
+    assert event_text.original_air_date == '2001-02-31'
+    assert event_text.original_air_dt is None
+
+
+def test_parseEventText_memoised():
+    parseEventText.cache_clear()
+    for _ in range(3):
+        parseEventText('News', '[News] Headlines', '')
+    cache_info = parseEventText.cache_info()
+    assert (cache_info.hits, cache_info.misses) == (2, 1)
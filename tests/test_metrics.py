@@ -0,0 +1,94 @@
+from datetime import timedelta
+from unittest.mock import Mock
+
+from owi2plex import RunMetrics
+
+
+def _response(latency, status_code=200, content=b'{}'):
+    return Mock(elapsed=timedelta(seconds=latency), status_code=status_code,
+        content=content, headers={})
+
+
+def test_RunMetrics_requests():
+    metrics = RunMetrics()
+    metrics.observeResponse(_response(0.02))
+    metrics.observeResponse(_response(0.3, content=b'{"events": []}'))
+    metrics.observeResponse(_response(60, status_code=500))
+    summary = metrics.summary()
+    assert summary['requests']['count'] == 3
+    assert summary['requests']['errors'] == 1
+    assert summary['requests']['bytes_received'] == 2 + 14 + 2
+    assert summary['requests']['latency_buckets']['0.025'] == 1
+    assert summary['requests']['latency_buckets']['0.5'] == 2
+    assert summary['requests']['latency_buckets']['30'] == 2
+
+
+def test_RunMetrics_phases_and_counts():
+    metrics = RunMetrics()
+    for _ in range(2):
+        with metrics.phase('render'):
+            pass
+    metrics.count('events', 10)
+    metrics.count('events', 5)
+    summary = metrics.summary()
+    assert list(summary['phases'].keys()) == ['render']
+    assert summary['counts'] == {'events': 15}
+
+
+def test_RunMetrics_prometheus():
+    metrics = RunMetrics()
+    with metrics.phase('epg'):
+        metrics.observeResponse(_response(0.2))
+    metrics.count('channels', 3)
+    lines = metrics.prometheus().splitlines()
+    assert any(l.startswith('owi2plex_phase_duration_seconds{phase="epg"} ') for l in lines)
+    assert 'owi2plex_request_duration_seconds_bucket{le="0.25"} 1' in lines
+    assert 'owi2plex_request_duration_seconds_bucket{le="+Inf"} 1' in lines
+    assert 'owi2plex_request_duration_seconds_count 1' in lines
+    assert 'owi2plex_channels 3' in lines
+
+
+def test_PhaseProfiler(tmpdir):
+    import pstats
+    import tracemalloc
+    from concurrent.futures import ThreadPoolExecutor
+    from owi2plex import PhaseProfiler
+
+    def allocateEvents():
+        return [{'title': str(n)} for n in range(5000)]
+
+    def fetchInThreads(results):
+        # The workers must run with the phase profiled, or the futures never end
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(allocateEvents) for _ in range(2)]
+            results.extend(future.result(timeout=10) for future in futures)
+
+    profiler = PhaseProfiler(str(tmpdir.join('profile')), snapshot_interval=0)
+    metrics = RunMetrics(profiler)
+    results = []
+    try:
+        for _ in range(2):
+            with metrics.phase('epg'):
+                fetchInThreads(results)
+        for _ in range(3):
+            with metrics.phase('render'):
+                allocateEvents()
+        # One profile per phase, and the threads that ended are merged
+        assert list(profiler.profiles) == ['epg', 'render']
+        assert profiler.thread_profiles == {'epg': [], 'render': []}
+        report_file = profiler.dump(metrics)
+    finally:
+        tracemalloc.stop()
+    assert len(results) == 4
+    assert set(metrics.summary()['phases']) == {'epg', 'render'}
+    # The function run by the thread started during the phase is profiled
+    epg_stats = pstats.Stats(str(tmpdir.join('profile', 'epg.prof')))
+    assert any(f[2] == 'allocateEvents' for f in epg_stats.stats)
+    render_stats = pstats.Stats(str(tmpdir.join('profile', 'render.prof')))
+    assert [c[0] for f, c in render_stats.stats.items() if f[2] == 'allocateEvents'] == [3]
+    assert tmpdir.join('profile', 'epg.tracemalloc').check()
+    report = tmpdir.join('profile', 'report.txt').read()
+    assert report_file == str(tmpdir.join('profile', 'report.txt'))
+    assert report.startswith('== epg')
+    assert 'allocateEvents' in report
+    assert 'test_metrics.py' in report.split('== render')[0].split('Largest allocations')[1]
@@ -0,0 +1,41 @@
+import os
+import random
+
+from owi2plex import CategoryOverrides, load_overrides
+
+
+EXAMPLE_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'cat_overrides_example.yml')
+
+
+def _naive_match(overrides, title):
+    categories = []
+    for pattern, override_categories in overrides.items():
+        if pattern in title.upper():
+            categories.extend(override_categories)
+    return categories
+
+
+def test_load_overrides_example():
+    overrides = load_overrides(EXAMPLE_FILE)
+    assert overrides.match('Champions League Live Tonight') == ['Sports', 'Football']
+    assert overrides.match('the nfl show') == ['Sports', 'Series']
+    assert overrides.match('BBC News at Six') == ['News']
+    assert overrides.match('Doctor Who') == []
+
+
+def test_load_overrides_none():
+    assert load_overrides(None) is None
+
+
+def test_CategoryOverrides_matches_naive():
+    random.seed(42)
+    alphabet = 'ABN: '
+    patterns = {}
+    for i in range(200):
+        pattern = ''.join(random.choice(alphabet) for _ in range(random.randint(1, 5)))
+        patterns.setdefault(pattern, []).append('Cat{}'.format(i))
+    overrides = CategoryOverrides(patterns)
+    for _ in range(500):
+        title = ''.join(random.choice(alphabet.lower() + alphabet) for _ in range(20))
+        assert overrides.match(title) == _naive_match(patterns, title)
@@ -0,0 +1,66 @@
+import gzip
+import threading
+
+import pytest
+import requests
+
+from http.server import ThreadingHTTPServer
+from owi2plex import XMLTVPublisher, digestEPG, makeXMLTVRequestHandler
+
+
+XMLTV = b'\xef\xbb\xbf<tv generator-info-name="OpenWebIf 2 Plex XMLTV"/>\n'
+
+
+@pytest.fixture
+def xmltv_server():
+    publisher = XMLTVPublisher()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), makeXMLTVRequestHandler(publisher))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield publisher, 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_serve_unavailable_until_published(xmltv_server):
+    _, url = xmltv_server
+    response = requests.get(url + '/epg.xml')
+    assert response.status_code == 503
+    assert requests.get(url + '/other.xml').status_code == 404
+
+
+def test_serve_etag_and_gzip(xmltv_server):
+    publisher, url = xmltv_server
+    publisher.publish(XMLTV, 'digest')
+
+    response = requests.get(url + '/epg.xml', headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200
+    assert response.content == XMLTV
+    etag = response.headers['ETag']
+
+    response = requests.get(url + '/epg.xml', headers={
+        'Accept-Encoding': 'identity', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+
+    response = requests.get(url + '/', headers={'Accept-Encoding': 'gzip'}, stream=True)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.raw.read()) == XMLTV
+    # Compressed without a timestamp, so the same guide gives the same body
+    assert publisher.get()['gzip'][0][4:8] == b'\0\0\0\0'
+    gzip_etag = response.headers['ETag']
+    assert gzip_etag != etag
+
+    response = requests.get(url + '/', headers={
+        'Accept-Encoding': 'gzip', 'If-Modified-Since': response.headers['Last-Modified']})
+    assert response.status_code == 304
+
+    publisher.publish(XMLTV.replace(b'/>', b'></tv>'), 'new digest')
+    response = requests.get(url + '/epg.xml', headers={
+        'Accept-Encoding': 'identity', 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert publisher.digest == 'new digest'
+
+
+def test_digestEPG(bouquets_services, epg):
+    assert digestEPG(bouquets_services, epg) == digestEPG(bouquets_services, epg)
+    assert digestEPG(bouquets_services, epg) != digestEPG(bouquets_services, {})
@@ -0,0 +1,91 @@
+import json
+import sqlite3
+
+import pytest
+from click.testing import CliRunner
+from lxml import etree
+
+import owi2plex
+from owi2plex import Target, loadTargets, expandTargets, targetsBouquets
+
+
+def test_loadTargets(tmpdir):
+    targets_file = tmpdir.join('targets.yml')
+    targets_file.write(u"""
+targets:
+  - output: "{bouquet}.xml"
+    bouquets: [TV, Sky UK]
+  - output: all.xml.gz
+    continuous_numbering: true
+  - output: epg.jsonl
+    bouquets: TV
+    category_override: false
+  - output: epg.db
+  - output: epg.out
+    format: sqlite
+""")
+    targets = loadTargets(str(targets_file), category_override='overrides.yml')
+    assert targets == [
+        Target('{bouquet}.xml', 'xmltv', ('TV', 'Sky UK'), False, 'overrides.yml'),
+        Target('all.xml.gz', 'xmltv', None, True, 'overrides.yml'),
+        Target('epg.jsonl', 'jsonl', ('TV',), False, None),
+        Target('epg.db', 'sqlite', None, False, 'overrides.yml'),
+        Target('epg.out', 'sqlite', None, False, 'overrides.yml'),
+    ]
+    assert targetsBouquets(targets) is None
+    assert targetsBouquets(targets[:1] + targets[2:3]) == ['TV', 'Sky UK']
+    expanded = list(expandTargets(targets[:2], {'TV': [], 'Sky UK': []}))
+    assert [t.output_file for t in expanded] == ['TV.xml', 'Sky_UK.xml', 'all.xml.gz']
+    assert expanded[1].bouquets == ('Sky UK',)
+
+    targets_file.write(u"targets:\n  - output: epg.csv\n    format: csv\n")
+    with pytest.raises(ValueError):
+        loadTargets(str(targets_file))
+
+
+def test_main_targets(tmpdir, monkeypatch, fake_openwebif):
+    monkeypatch.chdir(str(tmpdir))
+    fake = fake_openwebif(bouquets=3, services=4, events=5, overlap=1)
+    tmpdir.join('targets.yml').write(u"""
+targets:
+  - output: "{bouquet}.xml"
+    bouquets: [Bouquet 0, Bouquet 1]
+  - output: combined.xml
+    bouquets: [Bouquet 0, Bouquet 1]
+    continuous_numbering: true
+  - output: epg.jsonl
+    bouquets: Bouquet 1
+  - output: epg.sqlite
+    bouquets: [Bouquet 0]
+""")
+    result = CliRunner().invoke(owi2plex.main, ['-h', fake.host, '-P', str(fake.port),
+        '--no-cache', '--targets', 'targets.yml'])
+    assert result.exit_code == 0, result.output
+    # Bouquet 2 isn't needed and every service is only requested once
+    assert fake.requests == 1 + 2 + 7
+
+    def parse(name):
+        with open(str(tmpdir.join(name)), 'rb') as f:
+            return etree.fromstring(f.read().decode('utf-8-sig').encode('utf-8'))
+
+    for name in ('Bouquet_0.xml', 'Bouquet_1.xml'):
+        xmltv = parse(name)
+        assert [c.findall('display-name')[1].text for c in xmltv.findall('channel')] == [
+            '1', '2', '3', '4']
+        assert len(xmltv.findall('programme')) == 4 * 5
+    combined = parse('combined.xml')
+    assert [c.findall('display-name')[1].text for c in combined.findall('channel')] == [
+        str(n) for n in range(1, 9)]
+    assert len(combined.findall('programme')) == 7 * 5
+
+    with open(str(tmpdir.join('epg.jsonl')), encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 4 * 5
+    assert records[0]['channel_number'] == 1
+    assert records[0]['stop'] - records[0]['start'] == records[0]['duration'] * 60
+
+    db = sqlite3.connect(str(tmpdir.join('epg.sqlite')))
+    assert db.execute('SELECT COUNT(*) FROM channels').fetchone()[0] == 4
+    assert db.execute('SELECT COUNT(*) FROM events').fetchone()[0] == 4 * 5
+    db.close()
+    assert not tmpdir.join('epg.xml').check()
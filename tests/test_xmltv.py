@@ -0,0 +1,224 @@
+import copy
+import gzip
+import lzma
+import os
+import re
+import time
+
+import pytest
+
+from lxml import etree
+from owi2plex import (addChannels2XML, addEvents2XML, createXMLTVRoot,
+    formatUTCOffset, formatXMLTVTime, generateXMLTV, writeXMLTV, FragmentCache,
+    RunMetrics)
+
+
+EXAMPLE_OVERRIDES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'cat_overrides_example.yml')
+
+
+def _without_date(xmltv):
+    return re.sub(r' date="[^"]*"', '', xmltv, count=1)
+
+
+def _full_tree_xmltv(bouquets_services, epg, api_root_url):
+    xmltv = createXMLTVRoot()
+    xmltv = addChannels2XML(xmltv, bouquets_services, epg, api_root_url, False)
+    xmltv = addEvents2XML(xmltv, epg, None)
+    return etree.tostring(xmltv, encoding='unicode', pretty_print=True)
+
+
+def test_generateXMLTV_matches_full_tree(bouquets_services, epg, openwebif_server):
+    expected = _full_tree_xmltv(bouquets_services, copy.deepcopy(epg), openwebif_server)
+    xmltv = generateXMLTV(bouquets_services, copy.deepcopy(epg), openwebif_server,
+        False, None)
+    assert _without_date(xmltv) == _without_date(expected)
+    assert xmltv.count('<channel ') == 3
+    assert xmltv.count('<programme ') == 6
+
+
+def test_generateXMLTV_empty(openwebif_server):
+    xmltv = generateXMLTV({}, {}, openwebif_server, False, None)
+    assert re.match(r'^<tv [^>]*/>\n$', xmltv)
+
+
+def test_writeXMLTV_streams_utf8_sig(tmpdir, bouquets_services, epg, openwebif_server):
+    expected = _full_tree_xmltv(bouquets_services, copy.deepcopy(epg), openwebif_server)
+    output_file = str(tmpdir.join('epg.xml'))
+    writeXMLTV(output_file, bouquets_services, copy.deepcopy(epg), openwebif_server,
+        False, None)
+    with open(output_file, 'rb') as f:
+        written = f.read()
+    assert written.startswith(b'\xef\xbb\xbf')
+    assert _without_date(written.decode('utf-8-sig')) == _without_date(expected)
+
+
+def test_addChannels2XML_bouquet_order(bouquets_services, epg, openwebif_server):
+    overlapping = bouquets_services.copy()
+    overlapping['Last Scanned'] = [bouquets_services['TV'][3], bouquets_services['TV'][0]]
+    xmltv = addChannels2XML(createXMLTVRoot(), overlapping, epg, openwebif_server, True)
+    channels = xmltv.findall('channel')
+    assert [c.attrib['id'] for c in channels] == ['6941', '6942', '6943', '6943', '6941']
+    assert [c.findall('display-name')[1].text for c in channels] == ['1', '2', '4', '5', '6']
+
+
+@pytest.fixture
+def local_timezone():
+    original_tz = os.environ.get('TZ')
+
+    def set_timezone(tz):
+        os.environ['TZ'] = tz
+        time.tzset()
+        formatXMLTVTime.cache_clear()
+
+    yield set_timezone
+    if original_tz is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = original_tz
+    time.tzset()
+    formatXMLTVTime.cache_clear()
+
+
+def test_formatUTCOffset():
+    assert formatUTCOffset(0) == '+0000'
+    assert formatUTCOffset(3600) == '+0100'
+    assert formatUTCOffset(-12600) == '-0330'
+    assert formatUTCOffset(20700) == '+0545'
+
+
+def test_formatXMLTVTime_dst(local_timezone):
+    local_timezone('Europe/Dublin')
+    # 2019-10-27 01:30 UTC, the summer time ends at 01:00 UTC
+    assert formatXMLTVTime(1572139800 - 3600) == '20191027013000 +0100'
+    assert formatXMLTVTime(1572139800) == '20191027013000 +0000'
+    local_timezone('America/St_Johns')
+    assert formatXMLTVTime(1572139800) == '20191026230000 -0230'
+
+
+def test_generateXMLTV_stop_across_dst(local_timezone, openwebif_server):
+    local_timezone('Europe/Dublin')
+    services = {'TV': [{"servicereference": "1:0:1", "servicename": "RTE One",
+        "program": 1, "pos": 1}]}
+    # A 2 hour film starting at 00:30 IST on the night the clocks go back
+    epg = {1: [{"begin_timestamp": 1572132600, "duration": 120, "title": "Film",
+        "shortdesc": "", "longdesc": "", "picon": "/picon/1.png"}]}
+    xmltv = generateXMLTV(services, epg, openwebif_server, False, None)
+    assert 'start="20191027003000 +0100" stop="20191027013000 +0000"' in xmltv
+
+
+def test_generateXMLTV_jobs(bouquets_services, epg, openwebif_server):
+    expected = generateXMLTV(bouquets_services, epg, openwebif_server, False,
+        EXAMPLE_OVERRIDES)
+    xmltv = generateXMLTV(bouquets_services, epg, openwebif_server, False,
+        EXAMPLE_OVERRIDES, jobs=2)
+    assert _without_date(xmltv) == _without_date(expected)
+    assert '<category lang="en">News</category>' in xmltv
+
+
+@pytest.mark.parametrize('output_name, decompress', [
+    ('epg.xml', lambda data: data),
+    ('epg.xml.gz', gzip.decompress),
+    ('epg.xml.xz', lzma.decompress)])
+def test_writeXMLTV_compressed(tmpdir, bouquets_services, epg, openwebif_server,
+        output_name, decompress):
+    expected = generateXMLTV(bouquets_services, epg, openwebif_server, False, None)
+    output_file = str(tmpdir.join(output_name))
+    assert writeXMLTV(output_file, bouquets_services, epg, openwebif_server, False, None)
+    with open(output_file, 'rb') as f:
+        written = decompress(f.read()).decode('utf-8-sig')
+    assert _without_date(written) == _without_date(expected)
+    assert sorted(os.listdir(str(tmpdir))) == sorted(['.{}.sha256'.format(output_name), output_name])
+
+
+def test_writeXMLTV_unchanged(tmpdir, bouquets_services, epg, openwebif_server):
+    output_file = str(tmpdir.join('epg.xml'))
+    assert writeXMLTV(output_file, bouquets_services, epg, openwebif_server, False, None)
+    inode = os.stat(output_file).st_ino
+    assert not writeXMLTV(output_file, bouquets_services, epg, openwebif_server, False, None)
+    assert os.stat(output_file).st_ino == inode
+    epg = copy.deepcopy(epg)
+    epg[6941][0]['title'] = 'News: Nine O\'Clock'
+    assert writeXMLTV(output_file, bouquets_services, epg, openwebif_server, False, None)
+    assert os.stat(output_file).st_ino != inode
+    assert len(os.listdir(str(tmpdir))) == 2
+
+
+def test_writeXMLTV_atomic(tmpdir, bouquets_services, epg, openwebif_server):
+    output_file = str(tmpdir.join('epg.xml'))
+    with open(output_file, 'w') as f:
+        f.write('previous')
+    epg = copy.deepcopy(epg)
+    del epg[6943][1]['duration']
+    with pytest.raises(KeyError):
+        writeXMLTV(output_file, bouquets_services, epg, openwebif_server, False, None)
+    with open(output_file) as f:
+        assert f.read() == 'previous'
+    assert os.listdir(str(tmpdir)) == ['epg.xml']
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_generateXMLTV_fragment_cache(tmpdir, bouquets_services, epg, openwebif_server,
+        jobs):
+    expected = generateXMLTV(bouquets_services, epg, openwebif_server, False, None)
+    cache = FragmentCache(str(tmpdir), 3600)
+    xmltv = generateXMLTV(bouquets_services, epg, openwebif_server, False, None, jobs, cache)
+    assert _without_date(xmltv) == _without_date(expected)
+    # 3 channels and the programmes of 3 services
+    assert (cache.stats['hits'], cache.stats['misses']) == (0, 6)
+
+    cache = FragmentCache(str(tmpdir), 3600)
+    xmltv = generateXMLTV(bouquets_services, epg, openwebif_server, False, None, jobs, cache)
+    assert _without_date(xmltv) == _without_date(expected)
+    assert (cache.stats['hits'], cache.stats['misses']) == (6, 0)
+
+    epg = copy.deepcopy(epg)
+    epg[6941][0]['title'] = 'News: Nine O\'Clock'
+    xmltv = generateXMLTV(bouquets_services, epg, openwebif_server, False, None, jobs, cache)
+    assert 'News: Nine O\'Clock' in xmltv
+    assert (cache.stats['hits'], cache.stats['misses']) == (11, 1)
+
+    xmltv = generateXMLTV(bouquets_services, epg, openwebif_server, False,
+        EXAMPLE_OVERRIDES, jobs, cache)
+    assert '<category lang="en">News</category>' in xmltv
+    assert (cache.stats['hits'], cache.stats['misses']) == (11, 7)
+
+
+def test_FragmentCache_expire(tmpdir):
+    cache = FragmentCache(str(tmpdir), 3600)
+    cache.put('a', '<a/>')
+    cache.put('b', '<b/>')
+    cache.flush(now=1000)
+    assert cache.get('a') == '<a/>'
+    cache.flush(now=5000)
+    assert cache.stats['expired'] == 1
+    assert cache.get('b') is None
+    assert cache.get('a') == '<a/>'
+
+
+def test_FragmentCache_batches(tmpdir, monkeypatch):
+    monkeypatch.setattr(FragmentCache, 'BATCH_FRAGMENTS', 3)
+    cache = FragmentCache(str(tmpdir), 3600)
+    for n in range(7):
+        cache.put(str(n), '<p n="{}"/>'.format(n))
+        assert len(cache.pending) < 3
+    # The fragments written in the open transaction can be read back
+    assert [cache.get(str(n)) for n in (0, 6)] == ['<p n="0"/>', '<p n="6"/>']
+    cache.flush()
+    cache.close()
+    cache = FragmentCache(str(tmpdir), 3600)
+    assert all(cache.get(str(n)) for n in range(7))
+
+
+def test_writeXMLTV_render_cache_metrics(tmpdir, bouquets_services, epg, openwebif_server):
+    cache = FragmentCache(str(tmpdir), 3600)
+    output_file = str(tmpdir.join('epg.xml'))
+    writeXMLTV(output_file, bouquets_services, epg, openwebif_server, False, None,
+        fragment_cache=cache)
+    metrics = RunMetrics()
+    writeXMLTV(output_file, bouquets_services, epg, openwebif_server, False, None,
+        metrics=metrics, fragment_cache=cache)
+    summary = metrics.summary()
+    assert summary['counts']['render_cache_hits'] == 6
+    assert summary['render_cache_hit_ratio'] == 1.0
+    assert 'owi2plex_render_cache_hit_ratio 1.0' in metrics.prometheus()